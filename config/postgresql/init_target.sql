@@ -6,6 +6,16 @@
 -- Tạo schema cho catalog
 CREATE SCHEMA IF NOT EXISTS catalog;
 
+-- Extension cho tìm kiếm gần đúng, không phân biệt dấu tiếng Việt
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS unaccent;
+
+-- unaccent() không IMMUTABLE nên cần hàm bọc để dùng trong index
+CREATE OR REPLACE FUNCTION catalog.search_text(name TEXT, description TEXT)
+RETURNS TEXT AS $$
+    SELECT lower(public.unaccent('public.unaccent'::regdictionary, concat_ws(' ', name, description)));
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
 -- =====================================================
 -- 1. BẢNG TABLE_ORIGIN - Lưu metadata của tables/views
 -- =====================================================
@@ -25,6 +35,9 @@ CREATE TABLE catalog.table_origin (
     update_time TIMESTAMP NOT NULL,              -- Thời gian cập nhật metadata
     skip BOOLEAN DEFAULT FALSE,                   -- Có bỏ qua trong quá trình xử lý không
     expire BOOLEAN DEFAULT FALSE,                 -- Đã hết hạn chưa
+    ddl_hash VARCHAR(32),                         -- Fingerprint DDL của bảng
+    rows_stale BOOLEAN DEFAULT FALSE,             -- Số dòng ước tính có thể đã cũ
+    harvested_at TIMESTAMP,                       -- Thời điểm thu thập gần nhất
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 
     CONSTRAINT chk_type CHECK (type IN ('table', 'view', 'matview', 'proc'))
@@ -36,6 +49,8 @@ CREATE INDEX idx_table_origin_schema_table ON catalog.table_origin(schema, table
 CREATE INDEX idx_table_origin_type ON catalog.table_origin(type);
 CREATE INDEX idx_table_origin_update_time ON catalog.table_origin(update_time);
 CREATE UNIQUE INDEX idx_table_origin_unique ON catalog.table_origin(datasource, database, schema, tablename);
+CREATE INDEX idx_table_origin_search ON catalog.table_origin
+    USING gin (catalog.search_text(tablename, business_term) gin_trgm_ops);
 
 -- Comments
 COMMENT ON TABLE catalog.table_origin IS 'Bảng lưu trữ metadata của tất cả tables, views, materialized views';
@@ -48,6 +63,9 @@ COMMENT ON COLUMN catalog.table_origin.size IS 'Kích thước bảng tính bằ
 COMMENT ON COLUMN catalog.table_origin.type IS 'Loại đối tượng: table, view, matview, proc';
 COMMENT ON COLUMN catalog.table_origin.skip IS 'Có bỏ qua bảng này trong quá trình xử lý không';
 COMMENT ON COLUMN catalog.table_origin.expire IS 'Bảng này đã không còn tồn tại trong source';
+COMMENT ON COLUMN catalog.table_origin.ddl_hash IS 'MD5 của danh sách cột, kiểu, comment và constraint; dùng cho thu thập incremental';
+COMMENT ON COLUMN catalog.table_origin.rows_stale IS 'Thống kê của bảng đã cũ nhưng chưa được ANALYZE trong lần thu thập này';
+COMMENT ON COLUMN catalog.table_origin.harvested_at IS 'Thời điểm thu thập gần nhất; update_time chỉ đổi khi metadata thay đổi';
 
 -- =====================================================
 -- 2. BẢNG FIELD_ORIGIN - Lưu metadata của columns
@@ -81,6 +99,8 @@ CREATE INDEX idx_field_origin_table_id ON catalog.field_origin(table_id);
 CREATE INDEX idx_field_origin_field ON catalog.field_origin(field);
 CREATE INDEX idx_field_origin_fieldtype ON catalog.field_origin(fieldtype);
 CREATE UNIQUE INDEX idx_field_origin_unique ON catalog.field_origin(table_id, field);
+CREATE INDEX idx_field_origin_search ON catalog.field_origin
+    USING gin (catalog.search_text(field, business_term) gin_trgm_ops);
 
 -- Comments
 COMMENT ON TABLE catalog.field_origin IS 'Bảng lưu trữ metadata của tất cả columns trong tables/views';
@@ -94,6 +114,28 @@ COMMENT ON COLUMN catalog.field_origin.field_demo2 IS 'Giá trị mẫu thứ 2
 COMMENT ON COLUMN catalog.field_origin.field_demo3 IS 'Giá trị mẫu thứ 3 từ dữ liệu thực tế';
 COMMENT ON COLUMN catalog.field_origin.business_term IS 'Mô tả nghiệp vụ của field (từ COMMENT ON COLUMN)';
 
+-- =====================================================
+-- 2b. BẢNG FIELD_PROFILE - Thống kê nội dung columns từ pg_stats
+-- =====================================================
+DROP TABLE IF EXISTS catalog.field_profile CASCADE;
+
+CREATE TABLE catalog.field_profile (
+    id VARCHAR(32) PRIMARY KEY,                    -- Trùng với field_origin.id
+    null_frac REAL,                               -- Tỷ lệ NULL
+    n_distinct REAL,                              -- n_distinct của pg_stats (âm = tỷ lệ theo số dòng)
+    distinct_estimate BIGINT,                     -- Số giá trị khác nhau ước tính
+    most_common_vals JSONB,                       -- Các giá trị phổ biến nhất
+    most_common_freqs JSONB,                      -- Tần suất của các giá trị phổ biến
+    histogram_bounds JSONB,                       -- Biên histogram
+    avg_width INTEGER,                            -- Độ rộng trung bình (bytes)
+    correlation REAL,                             -- Tương quan thứ tự vật lý/logic
+    update_time TIMESTAMP NOT NULL,              -- Thời gian cập nhật profile
+
+    CONSTRAINT fk_profile_field FOREIGN KEY (id) REFERENCES catalog.field_origin(id) ON DELETE CASCADE
+);
+
+COMMENT ON TABLE catalog.field_profile IS 'Profile nội dung của columns, lấy từ pg_stats không cần quét dữ liệu';
+
 -- =====================================================
 -- 3. BẢNG DATA_LINEAGE - Theo dõi nguồn gốc dữ liệu
 -- =====================================================
@@ -137,6 +179,7 @@ CREATE TABLE catalog.metadata_jobs (
     tables_processed INTEGER DEFAULT 0,          -- Số bảng đã xử lý
     fields_processed INTEGER DEFAULT 0,          -- Số field đã xử lý
     error_message TEXT,                          -- Lỗi nếu có
+    stage_timings JSONB,                         -- Thời gian (giây) từng stage theo database
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 
     CONSTRAINT chk_job_status CHECK (status IN ('SUCCESS', 'FAILED', 'RUNNING', 'CANCELLED'))
@@ -216,13 +259,14 @@ BEGIN
     RETURN QUERY
     SELECT t.datasource, t.database, t.schema, t.tablename, t.type, t.business_term
     FROM catalog.table_origin t
-    WHERE LOWER(t.tablename) LIKE LOWER('%' || search_term || '%')
-       OR LOWER(t.business_term) LIKE LOWER('%' || search_term || '%')
-    ORDER BY t.datasource, t.database, t.schema, t.tablename;
+    WHERE catalog.search_text(t.tablename, t.business_term) LIKE '%' || catalog.search_text(search_term, NULL) || '%'
+       OR catalog.search_text(search_term, NULL) <% catalog.search_text(t.tablename, t.business_term)
+    ORDER BY word_similarity(catalog.search_text(search_term, NULL), catalog.search_text(t.tablename, t.business_term)) DESC,
+             t.datasource, t.database, t.schema, t.tablename;
 END;
 $$ LANGUAGE plpgsql;
 
-COMMENT ON FUNCTION catalog.search_tables(TEXT) IS 'Tìm kiếm bảng theo tên hoặc mô tả nghiệp vụ';
+COMMENT ON FUNCTION catalog.search_tables(TEXT) IS 'Tìm kiếm bảng theo tên hoặc mô tả nghiệp vụ (không phân biệt dấu, dùng index trigram)';
 
 -- Function thống kê metadata
 CREATE OR REPLACE FUNCTION catalog.get_metadata_stats()
@@ -301,6 +345,17 @@ COMMENT ON COLUMN catalog.dashboards.name IS 'Tên của dashboard';
 COMMENT ON COLUMN catalog.dashboards.description IS 'Mô tả chi tiết dashboard';
 COMMENT ON COLUMN catalog.dashboards.created_at IS 'Thời điểm tạo dashboard';
 
+-- Bảng template Plotly dùng chung, mỗi biểu đồ chỉ lưu khóa tham chiếu
+CREATE TABLE catalog.chart_templates (
+    id VARCHAR(32) PRIMARY KEY, -- md5 của template JSON (sort_keys)
+    template JSONB NOT NULL,    -- layout.template của Plotly
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON TABLE catalog.chart_templates IS 'Template Plotly dùng chung cho các biểu đồ';
+COMMENT ON COLUMN catalog.chart_templates.id IS 'Mã băm md5 của nội dung template';
+COMMENT ON COLUMN catalog.chart_templates.template IS 'Nội dung layout.template của Plotly';
+
 -- Tạo bảng charts
 CREATE TABLE catalog.charts (
     id SERIAL PRIMARY KEY,
@@ -311,7 +366,9 @@ CREATE TABLE catalog.charts (
     type TEXT NOT NULL,      -- Loại biểu đồ: bar, line, pie, ...
     config JSONB,            -- Cấu hình vẽ (cột x, y, template, v.v.)
     filters JSONB,           -- Điều kiện lọc dữ liệu
-    json_data JSONB,         -- Dữ liệu biểu đồ (Plotly JSON)
+    json_data JSONB,         -- Dữ liệu biểu đồ (Plotly JSON, không kèm layout.template)
+    template_id VARCHAR(32) REFERENCES catalog.chart_templates(id), -- Template dùng chung
+    content_hash VARCHAR(32), -- Mã băm dữ liệu đầu vào và cấu hình, dùng để bỏ qua biểu đồ không đổi
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -328,8 +385,32 @@ COMMENT ON COLUMN catalog.charts.type IS 'Loại biểu đồ (bar, line, pie, v
 COMMENT ON COLUMN catalog.charts.config IS 'Cấu hình biểu đồ';
 COMMENT ON COLUMN catalog.charts.filters IS 'Điều kiện lọc dữ liệu';
 COMMENT ON COLUMN catalog.charts.json_data IS 'Dữ liệu Plotly JSON';
+COMMENT ON COLUMN catalog.charts.template_id IS 'Khóa ngoại đến template Plotly dùng chung';
+COMMENT ON COLUMN catalog.charts.content_hash IS 'Mã băm dữ liệu nguồn và cấu hình của biểu đồ';
 COMMENT ON COLUMN catalog.charts.created_at IS 'Thời điểm tạo biểu đồ';
 
+-- Quy tắc sinh biểu đồ theo dashboard và chỉ tiêu
+CREATE TABLE catalog.chart_specs (
+    id SERIAL PRIMARY KEY,
+    dashboard_id INTEGER REFERENCES catalog.dashboards(id) ON DELETE CASCADE, -- NULL: mọi dashboard
+    indicator_pattern TEXT NOT NULL DEFAULT '%', -- Mẫu LIKE trên ind_code
+    chart_type TEXT NOT NULL,                    -- bar, line, pie, dial
+    x_column TEXT NOT NULL DEFAULT 'org_name',   -- Cột trục x / nhãn / tiêu đề biểu đồ theo dòng
+    value_columns TEXT[] NOT NULL,               -- Các cột giá trị
+    per_row BOOLEAN NOT NULL DEFAULT FALSE,      -- Mỗi dòng dữ liệu một biểu đồ
+    aggregation TEXT,                            -- sum, avg, min, max, count
+    config JSONB NOT NULL DEFAULT '{}',          -- Cấu hình vẽ bổ sung
+    priority INTEGER NOT NULL DEFAULT 0,         -- Quy tắc ưu tiên cao được khớp trước
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON TABLE catalog.chart_specs IS 'Quy tắc khai báo cách sinh biểu đồ cho từng nhóm chỉ tiêu';
+
+INSERT INTO catalog.chart_specs (indicator_pattern, chart_type, value_columns, per_row, config, priority) VALUES
+    ('Bhxh1', 'dial', ARRAY['tt5', 'tt4'], TRUE, '{}', 10),
+    ('Bhxh3', 'bar', ARRAY['tt5'], FALSE, '{"orientation": "h", "x_title": "Phòng ban", "y_title": "Cư dân"}', 10),
+    ('%', 'bar', ARRAY['tt5', 'tt4'], FALSE, '{"orientation": "v", "barmode": "group", "x_title": "Phòng ban", "y_title": "Giá trị"}', 0);
+
 -- Tạo chỉ mục (indexes)
 CREATE INDEX idx_dashboards_name ON catalog.dashboards(name);
 CREATE INDEX idx_charts_dashboard_id ON catalog.charts(dashboard_id);
@@ -30,6 +30,35 @@ class Settings:
         # Chart storage
         CHART_STORAGE_PATH = "storage/charts/"
 
+        # Catalog harvest settings
+        self.HARVEST_WORKERS = int(os.getenv("HARVEST_WORKERS", 4))
+        self.HARVEST_DB_TIMEOUT = float(os.getenv("HARVEST_DB_TIMEOUT", 600))
+        self.HARVEST_INCREMENTAL = os.getenv("HARVEST_INCREMENTAL", "False").lower() == "true"
+        self.HARVEST_ANALYZE_MODE = os.getenv("HARVEST_ANALYZE_MODE", "stale")  # stale, full, off
+        self.HARVEST_ANALYZE_BUDGET = int(os.getenv("HARVEST_ANALYZE_BUDGET", 20))
+        self.HARVEST_ANALYZE_MOD_RATIO = float(os.getenv("HARVEST_ANALYZE_MOD_RATIO", 0.1))
+        self.HARVEST_SAMPLE_TIMEOUT_MS = int(os.getenv("HARVEST_SAMPLE_TIMEOUT_MS", 2000))
+        self.HARVEST_SAMPLE_MAX_LENGTH = int(os.getenv("HARVEST_SAMPLE_MAX_LENGTH", 200))
+        self.HARVEST_SAMPLE_MAX_VIEW_COST = float(os.getenv("HARVEST_SAMPLE_MAX_VIEW_COST", 100000))
+        self.HARVEST_PROFILE = os.getenv("HARVEST_PROFILE", "True").lower() == "true"
+
+        # Chart generation settings
+        self.CHART_SAVE_BATCH_SIZE = int(os.getenv("CHART_SAVE_BATCH_SIZE", 500))
+        self.CHART_RENDER_WORKERS = int(os.getenv("CHART_RENDER_WORKERS", os.cpu_count() or 1))
+        self.CHART_RENDER_CHUNKSIZE = int(os.getenv("CHART_RENDER_CHUNKSIZE", 16))
+        self.CHART_BACKEND = os.getenv("CHART_BACKEND", "plotly")  # plotly, native
+        self.CHART_INCREMENTAL = os.getenv("CHART_INCREMENTAL", "True").lower() == "true"
+        self.CHART_EXTRACT_CHUNK_SIZE = int(os.getenv("CHART_EXTRACT_CHUNK_SIZE", 10000))
+
+        # CDC sync settings
+        self.SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", 500))
+        self.SYNC_BATCH_TIMEOUT_MS = int(os.getenv("SYNC_BATCH_TIMEOUT_MS", 1000))
+        self.SYNC_RETRY_BACKOFF_S = float(os.getenv("SYNC_RETRY_BACKOFF_S", 5))
+        self.SYNC_MAX_RETRIES = int(os.getenv("SYNC_MAX_RETRIES", 5))  # lỗi tạm thời quá số lần này thì dừng consumer
+        self.SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", 1))
+        self.SYNC_QUEUE_SIZE = int(os.getenv("SYNC_QUEUE_SIZE", 4))
+        self.SYNC_INDEX_REFRESH_S = float(os.getenv("SYNC_INDEX_REFRESH_S", 300))  # 0: chỉ nạp lúc khởi động
+
         #Dash ID
         self.CHI_TIEU_THANG = 7753
         self.CHI_TIEU_THANG_PHONG_BAN = 7759
@@ -51,7 +80,7 @@ class Settings:
         return {
             'bootstrap_servers': ['localhost:9092'],
             'auto_offset_reset': 'earliest',
-            'enable_auto_commit': True,
+            'enable_auto_commit': False,
             'group_id': 'sync-pg-tables',
             'value_deserializer': lambda value: json.loads(value.decode('utf-8')),
         }
@@ -0,0 +1 @@
+# Đặt ở thư mục gốc để pytest thêm thư mục này vào sys.path, test import được src và config
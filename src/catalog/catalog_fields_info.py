@@ -26,9 +26,44 @@ class FieldMetadata:
     default_value: Optional[str] = None
     position: int = 0
 
-def get_sample_data(database: str, schema: str, table_name: str, limit: int = 3) -> List[Tuple]:
+FIELD_ORIGIN_COLUMNS = [
+    "id", "table_id", "field", "fieldtype", "field_length", "field_demo", "field_demo2", "field_demo3",
+    "business_term", "is_nullable", "is_primary_key", "is_foreign_key", "default_value", "position", "update_time",
+]
+
+def field_id(table_id: str, name: str) -> str:
+    """ID của field_origin, dùng chung cho mọi bảng tham chiếu tới field (field_profile...)"""
+    return hashlib.md5(f"{table_id}.{name}".encode()).hexdigest()
+
+def build_field(row: Tuple, sample_data: List[Tuple], pk_fields: set, fk_fields: set) -> FieldMetadata:
+    """Tạo FieldMetadata từ một dòng pg_attribute (name, type, position, length, comment, nullable, default)"""
+    position = row[2]
+
+    demo_values = []
+    if sample_data:
+        for sample_row in sample_data:
+            if position - 1 < len(sample_row):
+                value = sample_row[position - 1]
+                demo_values.append(str(value) if value is not None else "")
+
+    return FieldMetadata(
+        name=row[0],
+        type=row[1],
+        length=row[3],
+        business_term=row[4],
+        demo_values=demo_values,
+        is_nullable=row[5],
+        is_primary_key=row[0] in pk_fields,
+        is_foreign_key=row[0] in fk_fields,
+        default_value=row[6],
+        position=position,
+    )
+
+def get_sample_data(database: str, schema: str, table_name: str, limit: int = 3,
+                    conn: Optional[PostgresConn] = None) -> List[Tuple]:
     """Lấy dữ liệu mẫu từ bảng"""
-    conn = PostgresConn("source", db=database)
+    own_conn = conn is None
+    conn = conn or PostgresConn("source", db=database)
     try:
         sql = f'SELECT * FROM "{schema}"."{table_name}" LIMIT {limit};'
         return conn.select(sql)
@@ -36,7 +71,8 @@ def get_sample_data(database: str, schema: str, table_name: str, limit: int = 3)
         logger.warning(f"Cannot extract data from {schema}.{table_name}: {str(e)}")
         return []
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
 
 def get_pk_fields(conn: PostgresConn, table_oid: int) -> set:
     try:
@@ -67,9 +103,11 @@ def get_fk_fields(conn: PostgresConn, table_oid: int) -> set:
         logger.warning(f"Cannot get foreign key fields: {e}")
         return set()
 
-def get_field_metadata(database: str, table_oid: int, sample_data: List[Tuple]) -> List[FieldMetadata]:
+def get_field_metadata(database: str, table_oid: int, sample_data: List[Tuple],
+                       conn: Optional[PostgresConn] = None) -> List[FieldMetadata]:
     """Lấy metadata của các trường trong bảng"""
-    conn = PostgresConn("source", db=database)
+    own_conn = conn is None
+    conn = conn or PostgresConn("source", db=database)
     try:
         sql = f"""
         SELECT a.attname as field_name,
@@ -84,7 +122,6 @@ def get_field_metadata(database: str, table_oid: int, sample_data: List[Tuple])
                END as field_length,
                d.description as business_term,
                NOT a.attnotnull as is_nullable,
-               a.atthasdef as has_default,
                pg_get_expr(ad.adbin, ad.adrelid) as default_value
         FROM pg_attribute a 
         LEFT JOIN pg_type t ON a.atttypid = t.oid
@@ -97,56 +134,128 @@ def get_field_metadata(database: str, table_oid: int, sample_data: List[Tuple])
         """
 
         result = conn.select(sql)
-        fields = []
 
         pk_fields = get_pk_fields(conn, table_oid)
         fk_fields = get_fk_fields(conn, table_oid)
 
+        return [build_field(row, sample_data, pk_fields, fk_fields) for row in result]
+
+    except Exception as e:
+        logger.warning("Cannot fetch field metadata: %s", e)
+        return []
+    finally:
+        if own_conn:
+            conn.close()
+
+def get_bulk_pk_fields(conn: PostgresConn, table_oids: Optional[List[int]] = None) -> Dict[int, set]:
+    """Lấy primary key của tất cả bảng trong database, theo table oid"""
+    sql = """
+        SELECT i.indrelid, a.attname
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE i.indisprimary
+          AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+          AND (%(oids)s::oid[] IS NULL OR i.indrelid = ANY(%(oids)s::oid[]));
+    """
+    pk_fields: Dict[int, set] = {}
+    for table_oid, field_name in conn.select(sql, {'oids': table_oids}):
+        pk_fields.setdefault(table_oid, set()).add(field_name)
+    return pk_fields
+
+def get_bulk_fk_fields(conn: PostgresConn, table_oids: Optional[List[int]] = None) -> Dict[int, set]:
+    """Lấy foreign key của tất cả bảng trong database, theo table oid"""
+    sql = """
+        SELECT c.conrelid, a.attname
+        FROM pg_constraint c
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+        JOIN pg_namespace n ON n.oid = c.connamespace
+        WHERE c.contype = 'f'
+          AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+          AND (%(oids)s::oid[] IS NULL OR c.conrelid = ANY(%(oids)s::oid[]));
+    """
+    fk_fields: Dict[int, set] = {}
+    for table_oid, field_name in conn.select(sql, {'oids': table_oids}):
+        fk_fields.setdefault(table_oid, set()).add(field_name)
+    return fk_fields
+
+def get_bulk_field_metadata(database: str,
+                            sample_data: Optional[Dict[int, List[Tuple]]] = None,
+                            conn: Optional[PostgresConn] = None,
+                            table_oids: Optional[List[int]] = None) -> Dict[int, List[FieldMetadata]]:
+    """Lấy metadata các trường của tất cả tables/views (hoặc các oid chỉ định) trong database với số query cố định"""
+    sample_data = sample_data or {}
+    own_conn = conn is None
+    conn = conn or PostgresConn("source", db=database)
+    try:
+        sql = """
+        SELECT a.attrelid as table_oid,
+               a.attname as field_name,
+               t.typname as field_type,
+               a.attnum as position,
+               CASE WHEN attlen > 0 
+                    THEN attlen 
+                    ELSE CASE WHEN a.atttypmod > 0
+                              THEN a.atttypmod - 4
+                              ELSE 0
+                         END 
+               END as field_length,
+               d.description as business_term,
+               NOT a.attnotnull as is_nullable,
+               pg_get_expr(ad.adbin, ad.adrelid) as default_value
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_type t ON a.atttypid = t.oid
+        LEFT JOIN pg_description d ON d.objsubid = a.attnum AND d.objoid = a.attrelid
+        LEFT JOIN pg_attrdef ad ON ad.adrelid = a.attrelid AND ad.adnum = a.attnum
+        WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+          AND c.relkind IN ('r', 'm', 'v')
+          AND a.attnum > 0 
+          AND NOT a.attisdropped
+          AND (%(oids)s::oid[] IS NULL OR a.attrelid = ANY(%(oids)s::oid[]))
+        ORDER BY a.attrelid, a.attnum;
+        """
+
+        result = conn.select(sql, {'oids': table_oids})
+
+        pk_fields = get_bulk_pk_fields(conn, table_oids)
+        fk_fields = get_bulk_fk_fields(conn, table_oids)
+
+        table_fields: Dict[int, List[FieldMetadata]] = {}
         for row in result:
-            position = row[2]
-
-            demo_values = []
-            if sample_data:
-                for sample_row in sample_data:
-                    if position - 1 < len(sample_row):
-                        value = sample_row[position - 1]
-                        demo_values.append(str(value) if value is not None else "")
-
-            fields.append(FieldMetadata(
-                name=row[0],
-                type=row[1],
-                length=row[3],
-                business_term=row[4],
-                demo_values=demo_values,
-                is_nullable=row[5],
-                is_primary_key=row[0] in pk_fields,
-                is_foreign_key=row[0] in fk_fields,
-                default_value=row[6],
-                position=position,
+            table_oid = row[0]
+            table_fields.setdefault(table_oid, []).append(build_field(
+                row[1:],
+                sample_data.get(table_oid, []),
+                pk_fields.get(table_oid, set()),
+                fk_fields.get(table_oid, set()),
             ))
 
-        return fields
+        return table_fields
 
     except Exception as e:
-        logger.warning("Cannot fetch field metadata: %s", e)
-        return []
+        logger.warning("Cannot fetch bulk field metadata: %s", e)
+        return {}
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
 
-def save_field_metadata(table_fields: Dict[str, List[FieldMetadata]], timestamp:str) -> None:
+def save_field_metadata(table_fields: Dict[str, List[FieldMetadata]], timestamp:str,
+                        conn: Optional[PostgresConn] = None) -> None:
     if not table_fields:
         return
-    conn = PostgresConn("target", db="debezium")
+    own_conn = conn is None
+    conn = conn or PostgresConn("target", db="debezium")
     try:
         values = []
         for table_id, fields in table_fields.items():
             for field in fields:
-                field_id = hashlib.md5(f"{table_id}.{field.name}".encode()).hexdigest()
-
                 demo_values = field.demo_values + [""] * (3 - len(field.demo_values))
 
                 values.append([
-                    field_id, table_id, field.name, field.type, field.length,
+                    field_id(table_id, field.name), table_id, field.name, field.type, field.length,
                     demo_values[0] if len(demo_values) > 0 else "",
                     demo_values[1] if len(demo_values) > 1 else "",
                     demo_values[2] if len(demo_values) > 2 else "",
@@ -155,32 +264,15 @@ def save_field_metadata(table_fields: Dict[str, List[FieldMetadata]], timestamp:
                     field.position, timestamp
                 ])
 
-        insert_sql = """
-            INSERT INTO catalog.field_origin 
-            (id, table_id, field, fieldtype, field_length, field_demo, field_demo2, field_demo3, 
-             business_term, is_nullable, is_primary_key, is_foreign_key, default_value, position, update_time)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id) DO UPDATE SET
-                table_id = EXCLUDED.table_id,
-                field = EXCLUDED.field,
-                fieldtype = EXCLUDED.fieldtype,
-                field_length = EXCLUDED.field_length,
-                field_demo = EXCLUDED.field_demo,
-                field_demo2 = EXCLUDED.field_demo2,
-                field_demo3 = EXCLUDED.field_demo3,
-                business_term = EXCLUDED.business_term,
-                is_nullable = EXCLUDED.is_nullable,
-                is_primary_key = EXCLUDED.is_primary_key,
-                is_foreign_key = EXCLUDED.is_foreign_key,
-                default_value = EXCLUDED.default_value,
-                position = EXCLUDED.position,
-                update_time = EXCLUDED.update_time       
-        """
-
-        conn.batch_insert(insert_sql, values)
-        logger.info(f"Successfully save %s rows to field metadata:", len(values))
+        # update_time không tính là thay đổi để tránh ghi lại các field giữ nguyên
+        changed = conn.copy_upsert(
+            "catalog.field_origin", FIELD_ORIGIN_COLUMNS, ["id"], values,
+            compare_columns=[col for col in FIELD_ORIGIN_COLUMNS if col not in ("id", "update_time")]
+        )
+        logger.info("Successfully save %s rows to field metadata (%s changed)", len(values), changed)
     except Exception as e:
         logger.error(f"Cannot save field metadata: {e}")
         raise e
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
@@ -0,0 +1,132 @@
+import json
+import logging
+from dataclasses import dataclass
+from typing import Optional, List
+
+from src.catalog.catalog_fields_info import field_id
+from src.catalog.catalog_tables_info import TableMetadata
+from src.utils.pg_conn import PostgresConn
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+@dataclass
+class FieldProfile:
+    """Thống kê nội dung của trường lấy từ pg_stats"""
+    id: str
+    table_id: str
+    name: str
+    null_frac: Optional[float]
+    n_distinct: Optional[float]
+    distinct_estimate: Optional[int]
+    most_common_vals: Optional[List[str]]
+    most_common_freqs: Optional[List[float]]
+    histogram_bounds: Optional[List[str]]
+    avg_width: Optional[int]
+    correlation: Optional[float]
+
+FIELD_PROFILE_COLUMNS = [
+    "id", "null_frac", "n_distinct", "distinct_estimate", "most_common_vals", "most_common_freqs",
+    "histogram_bounds", "avg_width", "correlation", "update_time",
+]
+
+def create_field_profile_table(conn: PostgresConn) -> None:
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS catalog.field_profile (
+            id VARCHAR(32) PRIMARY KEY REFERENCES catalog.field_origin(id) ON DELETE CASCADE,
+            null_frac REAL,
+            n_distinct REAL,
+            distinct_estimate BIGINT,
+            most_common_vals JSONB,
+            most_common_freqs JSONB,
+            histogram_bounds JSONB,
+            avg_width INTEGER,
+            correlation REAL,
+            update_time TIMESTAMP NOT NULL
+        );
+    """)
+
+def get_field_profiles(database: str, tables: List[TableMetadata],
+                       conn: Optional[PostgresConn] = None) -> List[FieldProfile]:
+    """Lấy thống kê pg_stats của tất cả trường trong database bằng một query"""
+    if not tables:
+        return []
+    table_ids = {table.oid: table.id for table in tables}
+    own_conn = conn is None
+    conn = conn or PostgresConn("source", db=database)
+    try:
+        sql = """
+        SELECT c.oid,
+               s.attname,
+               s.null_frac,
+               s.n_distinct,
+               CASE WHEN s.n_distinct >= 0 THEN s.n_distinct
+                    ELSE -s.n_distinct * GREATEST(c.reltuples, 0)
+               END::bigint AS distinct_estimate,
+               array_to_json(s.most_common_vals::text::text[]),
+               array_to_json(s.most_common_freqs),
+               array_to_json(s.histogram_bounds::text::text[]),
+               s.avg_width,
+               s.correlation
+        FROM pg_stats s
+        JOIN pg_namespace n ON n.nspname = s.schemaname
+        JOIN pg_class c ON c.relnamespace = n.oid AND c.relname = s.tablename
+        WHERE c.oid = ANY(%s::oid[])
+          AND NOT s.inherited;
+        """
+
+        profiles = []
+        for row in conn.select(sql, (list(table_ids),)):
+            table_id = table_ids[row[0]]
+            profiles.append(FieldProfile(
+                id=field_id(table_id, row[1]),
+                table_id=table_id,
+                name=row[1],
+                null_frac=row[2],
+                n_distinct=row[3],
+                distinct_estimate=row[4],
+                most_common_vals=row[5],
+                most_common_freqs=row[6],
+                histogram_bounds=row[7],
+                avg_width=row[8],
+                correlation=row[9],
+            ))
+        return profiles
+
+    except Exception as e:
+        logger.warning("Cannot fetch field profiles: %s", e)
+        return []
+    finally:
+        if own_conn:
+            conn.close()
+
+def save_field_profiles(profiles: List[FieldProfile], timestamp: str,
+                        conn: Optional[PostgresConn] = None) -> None:
+    if not profiles:
+        return
+    own_conn = conn is None
+    conn = conn or PostgresConn("target", db="debezium")
+    try:
+        values = []
+        for profile in profiles:
+            values.append([
+                profile.id, profile.null_frac, profile.n_distinct, profile.distinct_estimate,
+                json.dumps(profile.most_common_vals, ensure_ascii=False) if profile.most_common_vals is not None else None,
+                json.dumps(profile.most_common_freqs) if profile.most_common_freqs is not None else None,
+                json.dumps(profile.histogram_bounds, ensure_ascii=False) if profile.histogram_bounds is not None else None,
+                profile.avg_width, profile.correlation, timestamp
+            ])
+
+        changed = conn.copy_upsert(
+            "catalog.field_profile", FIELD_PROFILE_COLUMNS, ["id"], values,
+            compare_columns=[col for col in FIELD_PROFILE_COLUMNS if col not in ("id", "update_time")]
+        )
+        logger.info("Successfully save %s rows to field profile (%s changed)", len(values), changed)
+    except Exception as e:
+        logger.error(f"Cannot save field profiles: {e}")
+    finally:
+        if own_conn:
+            conn.close()
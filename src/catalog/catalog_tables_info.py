@@ -1,9 +1,12 @@
 import hashlib
 import os
 import logging
+import threading
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Optional, List
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Tuple
+
+from psycopg2 import sql as pgsql
 
 from src.utils.pg_conn import PostgresConn
 
@@ -26,10 +29,40 @@ class TableMetadata:
     type: str
     database: str
     frequency: str = "1d"
+    ddl_hash: Optional[str] = None
+    rows_stale: bool = False
+
+@dataclass
+class StatisticsPolicy:
+    """Chính sách làm mới thống kê trước khi đọc reltuples"""
+    mode: str = "stale"             # 'stale': chỉ ANALYZE bảng cũ, 'full': ANALYZE cả database, 'off'
+    budget: int = 20                # Số bảng tối đa được ANALYZE mỗi database
+    mod_ratio: float = 0.1          # Tỷ lệ dòng thay đổi so với reltuples để coi là cũ
+    min_mods: int = 50              # Số dòng thay đổi tối thiểu để coi là cũ
+
+TABLE_ORIGIN_COLUMNS = [
+    "id", "datasource", "database", "schema", "tablename", "business_term", "frequency", "rows", "size",
+    "type", "update_time", "skip", "expire", "ddl_hash", "rows_stale",
+]
+
+FREQUENCY_UNITS = {
+    'm': timedelta(minutes=1),
+    'h': timedelta(hours=1),
+    'd': timedelta(days=1),
+    'w': timedelta(weeks=1),
+}
+
+def parse_frequency(frequency: Optional[str]) -> timedelta:
+    """Chuyển tần suất dạng '1h', '6h', '1d', '1w' thành timedelta"""
+    try:
+        return int(frequency[:-1]) * FREQUENCY_UNITS[frequency[-1]]
+    except (TypeError, ValueError, KeyError, IndexError):
+        return FREQUENCY_UNITS['d']
 
 
-def describe_databases() -> List[str]:
-    conn = PostgresConn("source")
+def describe_databases(conn: Optional[PostgresConn] = None) -> List[str]:
+    own_conn = conn is None
+    conn = conn or PostgresConn("source")
     try:
         sql_get_dbs = f"""
         SELECT datname FROM pg_database WHERE datistemplate = false;
@@ -39,14 +72,57 @@ def describe_databases() -> List[str]:
         logger.error(e)
         return []
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
+
+def refresh_statistics(conn: PostgresConn, policy: StatisticsPolicy,
+                       stop: Optional[threading.Event] = None) -> set:
+    """ANALYZE các bảng có thống kê cũ trong giới hạn budget, trả về oid các bảng vẫn còn cũ"""
+    if policy.mode == "full":
+        conn.execute("ANALYZE VERBOSE;")
+        return set()
+    # 'off': không ANALYZE nhưng vẫn đọc danh sách bảng cũ để rows_stale phản ánh đúng
+    budget = policy.budget if policy.mode == "stale" else 0
+
+    get_stale_query = """
+        SELECT s.relid, s.schemaname, s.relname
+        FROM pg_stat_user_tables s
+        JOIN pg_class c ON c.oid = s.relid
+        WHERE (s.last_analyze IS NULL AND s.last_autoanalyze IS NULL AND s.n_mod_since_analyze > 0)
+           OR s.n_mod_since_analyze > %(min_mods)s + %(mod_ratio)s * GREATEST(c.reltuples, 0)
+        ORDER BY (s.last_analyze IS NULL AND s.last_autoanalyze IS NULL) DESC,
+                 s.n_mod_since_analyze DESC;
+    """
+    try:
+        stale = conn.select(get_stale_query, {'min_mods': policy.min_mods, 'mod_ratio': policy.mod_ratio})
+    except Exception as e:
+        logger.warning(f"Cannot read table statistics: {e}")
+        return set()
+
+    analyzed = set()
+    for relid, schema, name in stale[:budget]:
+        # Hủy khi hết giờ chỉ dừng câu ANALYZE đang chạy, không dừng cả vòng lặp
+        if stop is not None and stop.is_set():
+            break
+        try:
+            conn.execute(pgsql.SQL("ANALYZE {}.{};").format(pgsql.Identifier(schema), pgsql.Identifier(name)))
+            analyzed.add(relid)
+        except Exception as e:
+            logger.warning(f"Cannot analyze {schema}.{name}: {e}")
+
+    left = {row[0] for row in stale if row[0] not in analyzed}
+    logger.info("Analyzed %s stale relations, %s left stale", len(analyzed), len(left))
+    return left
 
-def get_table_metadata(database: str) -> List[TableMetadata]:
+def get_table_metadata(database: str, conn: Optional[PostgresConn] = None,
+                       policy: Optional[StatisticsPolicy] = None,
+                       stop: Optional[threading.Event] = None) -> List[TableMetadata]:
     """Lấy metadata của tất cả tables/views trong database"""
-    conn = PostgresConn("source", db=database)
+    own_conn = conn is None
+    conn = conn or PostgresConn("source", db=database)
     try:
         # Refresh system tables
-        conn.execute("ANALYZE VERBOSE;")
+        stale_oids = refresh_statistics(conn, policy or StatisticsPolicy(), stop)
 
         get_table_metadata_query = f"""
         SELECT 
@@ -61,7 +137,21 @@ def get_table_metadata(database: str) -> List[TableMetadata]:
                 WHEN 'm' THEN 'matview'
                 WHEN 'v' THEN 'view'
                 ELSE c.relkind::text
-            END AS type
+            END AS type,
+            md5(concat_ws('|',
+                c.relkind,
+                d.description,
+                (SELECT string_agg(concat_ws(':', a.attname, format_type(a.atttypid, a.atttypmod),
+                                             a.attnotnull, col_description(c.oid, a.attnum),
+                                             pg_get_expr(ad.adbin, ad.adrelid)),
+                                   ',' ORDER BY a.attnum)
+                 FROM pg_attribute a
+                 LEFT JOIN pg_attrdef ad ON ad.adrelid = a.attrelid AND ad.adnum = a.attnum
+                 WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped),
+                (SELECT string_agg(co.oid::text, ',' ORDER BY co.oid)
+                 FROM pg_constraint co
+                 WHERE co.conrelid = c.oid)
+            )) AS ddl_hash
         FROM pg_class c
         JOIN pg_namespace n ON n.oid = c.relnamespace
         LEFT JOIN pg_description d ON d.objoid = c.oid AND d.objsubid = 0
@@ -84,7 +174,9 @@ def get_table_metadata(database: str) -> List[TableMetadata]:
                 business_term=row[4],
                 oid=row[5],
                 type=row[6],
-                database=database
+                database=database,
+                ddl_hash=row[7],
+                rows_stale=row[5] in stale_oids,
             ))
 
         return tables
@@ -97,13 +189,16 @@ def get_table_metadata(database: str) -> List[TableMetadata]:
         )
         return []
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
 
-def save_table_metadata(tables: List[TableMetadata], timestamp:str) -> None:
+def save_table_metadata(tables: List[TableMetadata], timestamp:str,
+                        conn: Optional[PostgresConn] = None, mark_harvested: bool = False) -> None:
     if not tables:
         return
 
-    conn = PostgresConn("target", db="debezium")
+    own_conn = conn is None
+    conn = conn or PostgresConn("target", db="debezium")
     datasource = conn.get_datasource()
     try:
         values = []
@@ -112,37 +207,80 @@ def save_table_metadata(tables: List[TableMetadata], timestamp:str) -> None:
             values.append([
                 table.id, datasource, table.database, table.schema, table.name,
                 table.business_term, table.frequency, table.rows, table.size, table.type,
-                timestamp, False, False
+                timestamp, False, False, table.ddl_hash, table.rows_stale
             ])
 
-        insert_sql = """
-            INSERT INTO catalog.table_origin (id, datasource, database, schema, tablename,
-                                      business_term, frequency, rows, size, type,
-                                      update_time, skip, expire)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id) DO UPDATE SET
-                datasource = EXCLUDED.datasource,
-                database = EXCLUDED.database,
-                schema = EXCLUDED.schema,
-                tablename = EXCLUDED.tablename,
-                business_term = EXCLUDED.business_term,
-                frequency = EXCLUDED.frequency,
-                rows = EXCLUDED.rows,
-                size = EXCLUDED.size,
-                type = EXCLUDED.type,
-                update_time = EXCLUDED.update_time,
-                skip = EXCLUDED.skip,
-                expire = EXCLUDED.expire
-        """
-
-        conn.batch_insert(insert_sql, values)
-        logger.info(f"Successfully save %s rows to table metadata:", len(values))
+        # update_time chỉ đổi khi metadata thay đổi; thời điểm thu thập ghi riêng vào harvested_at
+        changed = conn.copy_upsert(
+            "catalog.table_origin", TABLE_ORIGIN_COLUMNS, ["id"], values,
+            compare_columns=[col for col in TABLE_ORIGIN_COLUMNS if col not in ("id", "update_time")]
+        )
+        if mark_harvested:
+            # Chỉ thu thập incremental cần harvested_at, và khi đó tables chỉ gồm các bảng đến hạn
+            conn.execute("""
+                UPDATE catalog.table_origin SET harvested_at = %s
+                WHERE id = ANY(%s);
+            """, (timestamp, [table.id for table in tables]))
+        logger.info("Successfully save %s rows to table metadata (%s changed)", len(values), changed)
 
 
     except Exception as e:
         logger.error(f"Cannot save table metadata: {e}")
     finally:
-        conn.close()
+        if own_conn:
+            conn.close()
+
+def add_harvest_columns(conn: PostgresConn) -> None:
+    conn.execute("""
+        ALTER TABLE catalog.table_origin
+        ADD COLUMN IF NOT EXISTS ddl_hash VARCHAR(32),
+        ADD COLUMN IF NOT EXISTS rows_stale BOOLEAN DEFAULT FALSE,
+        ADD COLUMN IF NOT EXISTS harvested_at TIMESTAMP;
+    """)
+
+def get_known_tables(conn: PostgresConn) -> Dict[str, Tuple[Optional[str], str, datetime]]:
+    """Lấy fingerprint, tần suất và thời điểm thu thập gần nhất của các bảng đã có trong catalog"""
+    sql = """
+        SELECT id, ddl_hash, frequency, COALESCE(harvested_at, update_time)
+        FROM catalog.table_origin
+        WHERE datasource = %s AND NOT expire;
+    """
+    try:
+        result = conn.select(sql, (conn.get_datasource(),))
+        return {row[0]: (row[1], row[2], row[3]) for row in result}
+    except Exception as e:
+        logger.warning("Cannot fetch known tables, harvesting everything: %s", e)
+        return {}
+
+def select_changed_tables(tables: List[TableMetadata],
+                          known: Dict[str, Tuple[Optional[str], str, datetime]],
+                          now: datetime) -> Tuple[List[TableMetadata], int]:
+    """Chỉ giữ lại các bảng mới, đổi DDL hoặc đã hết chu kỳ frequency"""
+    changed = []
+    skipped = 0
+    for table in tables:
+        if table.id in known:
+            ddl_hash, frequency, harvested_at = known[table.id]
+            table.frequency = frequency or table.frequency
+            if ddl_hash == table.ddl_hash and harvested_at + parse_frequency(frequency) > now:
+                skipped += 1
+                continue
+        changed.append(table)
+    return changed, skipped
+
+def expire_missing_tables(seen: Dict[str, List[str]], timestamp: str, conn: PostgresConn) -> None:
+    """Đánh dấu expire cho các bảng không còn tồn tại trong source"""
+    datasource = conn.get_datasource()
+    try:
+        for database, table_ids in seen.items():
+            conn.execute("""
+                UPDATE catalog.table_origin
+                SET expire = true, update_time = %s
+                WHERE datasource = %s AND database = %s AND NOT expire
+                  AND NOT (id = ANY(%s));
+            """, (timestamp, datasource, database, table_ids))
+    except Exception as e:
+        logger.error(f"Cannot expire missing tables: {e}")
 
 def collect_table_metadata():
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,243 @@
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Cột của bảng báo cáo sau khi join tổ chức, kỳ báo cáo và báo cáo
+SOURCE_COLUMNS = ['report_id', 'report_name', 'prd_id', 'period_name', 'org_name', 'hash_id',
+                  'ind_name', 'ind_code', 'ind_unit', 'tt4', 'tt5']
+
+AGGREGATIONS = {'sum': 'SUM', 'avg': 'AVG', 'min': 'MIN', 'max': 'MAX', 'count': 'COUNT'}
+
+CHART_TYPES = ('bar', 'line', 'pie', 'dial')
+
+# Cột luôn có trong kết quả của compile_rule_query
+_META_COLUMNS = ('ind_code', 'ind_name', 'ind_unit', 'hash_id')
+
+_IDENTIFIER = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+
+@dataclass
+class ChartRule:
+    """Quy tắc sinh biểu đồ cho các chỉ tiêu có ind_code khớp indicator_pattern (cú pháp LIKE)"""
+    chart_type: str
+    value_columns: List[str]
+    indicator_pattern: str = '%'
+    dashboard_id: Optional[int] = None  # None: áp dụng cho mọi dashboard
+    x_column: str = 'org_name'
+    per_row: bool = False  # mỗi dòng dữ liệu một biểu đồ, tiêu đề lấy từ x_column
+    aggregation: Optional[str] = None  # sum, avg, min, max, count; None: giữ nguyên từng dòng
+    config: Dict[str, Any] = field(default_factory=dict)
+    priority: int = 0
+    id: Optional[int] = None
+
+    def matches(self, dashboard_id: int, ind_code: str) -> bool:
+        if self.dashboard_id is not None and self.dashboard_id != dashboard_id:
+            return False
+        return like_to_regex(self.indicator_pattern).match(ind_code) is not None
+
+
+# Tương đương các nhánh Bhxh1 / Bhxh3 / mặc định trước đây của gen_dash
+DEFAULT_CHART_RULES = [
+    ChartRule('dial', ['tt5', 'tt4'], indicator_pattern='Bhxh1', per_row=True, priority=10),
+    ChartRule('bar', ['tt5'], indicator_pattern='Bhxh3', priority=10, config={
+        'orientation': 'h',
+        'x_title': 'Phòng ban',
+        'y_title': 'Cư dân',
+    }),
+    ChartRule('bar', ['tt5', 'tt4'], config={
+        'orientation': 'v',
+        'barmode': 'group',
+        'x_title': 'Phòng ban',
+        'y_title': 'Giá trị',
+    }),
+]
+
+CHART_RULE_COLUMNS = [
+    "dashboard_id", "indicator_pattern", "chart_type", "x_column", "value_columns",
+    "per_row", "aggregation", "config", "priority",
+]
+
+
+def like_to_regex(pattern: str) -> re.Pattern:
+    parts = [".*" if ch == '%' else "." if ch == '_' else re.escape(ch) for ch in pattern]
+    return re.compile("^" + "".join(parts) + "$", re.DOTALL)
+
+
+def create_chart_spec_table(conn) -> None:
+    """Tạo bảng catalog.chart_specs và nạp các quy tắc mặc định nếu bảng còn trống"""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS catalog.chart_specs (
+            id SERIAL PRIMARY KEY,
+            dashboard_id INTEGER REFERENCES catalog.dashboards(id) ON DELETE CASCADE,
+            indicator_pattern TEXT NOT NULL DEFAULT '%',
+            chart_type TEXT NOT NULL,
+            x_column TEXT NOT NULL DEFAULT 'org_name',
+            value_columns TEXT[] NOT NULL,
+            per_row BOOLEAN NOT NULL DEFAULT FALSE,
+            aggregation TEXT,
+            config JSONB NOT NULL DEFAULT '{}',
+            priority INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """))
+    if conn.execute(text("SELECT EXISTS (SELECT 1 FROM catalog.chart_specs)")).scalar():
+        return
+    for rule in DEFAULT_CHART_RULES:
+        save_chart_rule(conn, rule)
+    logger.info("Seeded %s default chart rules", len(DEFAULT_CHART_RULES))
+
+
+def save_chart_rule(conn, rule: ChartRule) -> int:
+    validate_rule(rule)
+    return conn.execute(text(f"""
+        INSERT INTO catalog.chart_specs ({', '.join(CHART_RULE_COLUMNS)})
+        VALUES (:dashboard_id, :indicator_pattern, :chart_type, :x_column, :value_columns,
+                :per_row, :aggregation, CAST(:config AS JSONB), :priority)
+        RETURNING id;
+    """), {
+        'dashboard_id': rule.dashboard_id,
+        'indicator_pattern': rule.indicator_pattern,
+        'chart_type': rule.chart_type,
+        'x_column': rule.x_column,
+        'value_columns': list(rule.value_columns),
+        'per_row': rule.per_row,
+        'aggregation': rule.aggregation,
+        'config': json.dumps(rule.config, ensure_ascii=False),
+        'priority': rule.priority,
+    }).scalar()
+
+
+def load_chart_rules(conn, dashboard_id: Optional[int] = None) -> List[ChartRule]:
+    """Đọc quy tắc theo thứ tự ưu tiên: priority cao trước, quy tắc riêng của dashboard trước quy tắc chung"""
+    result = conn.execute(text(f"""
+        SELECT id, {', '.join(CHART_RULE_COLUMNS)}
+        FROM catalog.chart_specs
+        WHERE CAST(:dashboard_id AS INTEGER) IS NULL OR dashboard_id IS NULL OR dashboard_id = :dashboard_id
+        ORDER BY priority DESC, dashboard_id IS NULL, id;
+    """), {'dashboard_id': dashboard_id}).mappings()
+
+    rules = []
+    for row in result:
+        rule = ChartRule(
+            id=row['id'],
+            dashboard_id=row['dashboard_id'],
+            indicator_pattern=row['indicator_pattern'],
+            chart_type=row['chart_type'],
+            x_column=row['x_column'],
+            value_columns=list(row['value_columns']),
+            per_row=row['per_row'],
+            aggregation=row['aggregation'],
+            config=row['config'] or {},
+            priority=row['priority'],
+        )
+        try:
+            validate_rule(rule)
+        except ValueError as e:
+            logger.warning("Skip chart rule %s: %s", rule.id, e)
+            continue
+        rules.append(rule)
+    return rules
+
+
+def validate_rule(rule: ChartRule) -> None:
+    if rule.chart_type not in CHART_TYPES:
+        raise ValueError(f"Unsupported chart type: {rule.chart_type}")
+    if not rule.value_columns:
+        raise ValueError("value_columns is empty")
+    for column in [rule.x_column, *rule.value_columns]:
+        if column not in SOURCE_COLUMNS:
+            raise ValueError(f"Unknown column: {column}")
+    if set(rule.value_columns) & set(_META_COLUMNS):
+        raise ValueError("value_columns cannot contain indicator columns")
+    if rule.aggregation is not None and rule.aggregation not in AGGREGATIONS:
+        raise ValueError(f"Unsupported aggregation: {rule.aggregation}")
+    if rule.chart_type == 'dial' and not rule.per_row:
+        raise ValueError("dial charts must be per_row")
+    # Nhiều value_columns được melt và tách màu theo Metric, biểu đồ line không hỗ trợ color_column
+    if rule.chart_type == 'line' and len(set(rule.value_columns)) > 1:
+        raise ValueError("line charts support a single value column")
+
+
+def assign_rules(rules: List[ChartRule], dashboard_id: int,
+                 ind_codes: List[str]) -> List[Tuple[ChartRule, List[str]]]:
+    """Mỗi ind_code dùng quy tắc khớp đầu tiên; trả về danh sách (quy tắc, các ind_code)"""
+    assigned: Dict[int, List[str]] = {}
+    for ind_code in ind_codes:
+        for idx, rule in enumerate(rules):
+            if rule.matches(dashboard_id, ind_code):
+                assigned.setdefault(idx, []).append(ind_code)
+                break
+        else:
+            logger.warning("No chart rule for indicator %s of dashboard %s", ind_code, dashboard_id)
+    return [(rules[idx], codes) for idx, codes in sorted(assigned.items())]
+
+
+def source_query(table_name: str) -> str:
+    if not _IDENTIFIER.match(table_name):
+        raise ValueError(f"Invalid report table: {table_name}")
+    return f"""
+        SELECT report_id, report_name, bc.prd_id, period_name, org_name, hash_id, ind_name, ind_code, ind_unit, tt4, tt5
+        FROM public.{table_name} bc
+        JOIN public.sys_organization o ON bc.org_id = o.id
+        JOIN public.rp_input_grant i ON bc.rp_input_grant_id = i.id
+        JOIN rp_period p ON p.id = i.period_id
+        JOIN rp_report r ON r.id = i.report_id
+    """
+
+
+def indicator_query(table_name: str):
+    return text(f"SELECT DISTINCT ind_code FROM ({source_query(table_name)}) src;")
+
+
+def compile_rule_query(rule: ChartRule, table_name: str, filter_col: str):
+    """Dịch quy tắc thành một câu SQL: chỉ lấy cột cần dùng, lọc ind_code và gộp nhóm ngay trong database.
+
+    Mỗi dòng kết quả có filter_value, ind_code, ind_name, ind_unit, hash_id, group_id (row_id của
+    biểu đồ gộp theo ind_code và kỳ), x_column và các value_columns; khi có aggregation thêm
+    member_ids (hash_id của các dòng gốc). Tham số: :ind_codes.
+    """
+    validate_rule(rule)
+    if filter_col not in SOURCE_COLUMNS:
+        raise ValueError(f"Unknown filter column: {filter_col}")
+
+    dims = [rule.x_column] if rule.x_column not in _META_COLUMNS else []
+    values = [col for col in dict.fromkeys(rule.value_columns) if col not in dims]
+    group_by = f"ind_code, {filter_col}"
+
+    if rule.aggregation and not rule.per_row:
+        agg = AGGREGATIONS[rule.aggregation]
+        select_list = ", ".join([
+            f"{filter_col} AS filter_value",
+            "ind_code",
+            "MIN(ind_name) AS ind_name",
+            "MIN(ind_unit) AS ind_unit",
+            "MIN(hash_id) AS hash_id",
+            f"MIN(MIN(hash_id)) OVER (PARTITION BY {group_by}) AS group_id",
+            "ARRAY_AGG(hash_id ORDER BY hash_id) AS member_ids",
+            *dims,
+            *[f"{agg}({col}) AS {col}" for col in values],
+        ])
+        tail = f"GROUP BY {', '.join([group_by, *dims])}"
+    else:
+        select_list = ", ".join([
+            f"{filter_col} AS filter_value",
+            "ind_code", "ind_name", "ind_unit", "hash_id",
+            f"MIN(hash_id) OVER (PARTITION BY {group_by}) AS group_id",
+            *dims,
+            *values,
+        ])
+        tail = ""
+
+    return text(f"""
+        SELECT {select_list}
+        FROM ({source_query(table_name)}) src
+        WHERE ind_code = ANY(:ind_codes)
+        {tail}
+        ORDER BY ind_code, filter_value, {rule.x_column}, hash_id;
+    """)
@@ -0,0 +1,82 @@
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Cột chuỗi lặp lại nhiều trong bảng báo cáo: lưu dạng category
+CATEGORY_COLUMNS = ['report_name', 'period_name', 'org_name', 'ind_name', 'ind_code', 'ind_unit']
+# Cột số: hạ xuống float32 / int nhỏ hơn khi không mất chính xác
+NUMERIC_COLUMNS = ['tt4', 'tt5']
+
+
+def optimize_dtypes(frame: pd.DataFrame) -> pd.DataFrame:
+    for column in frame.columns:
+        if column in CATEGORY_COLUMNS:
+            frame[column] = frame[column].astype('category')
+        elif column in NUMERIC_COLUMNS:
+            frame[column] = downcast_numeric(frame[column])
+    return frame
+
+
+def downcast_numeric(series: pd.Series) -> pd.Series:
+    # NUMERIC của Postgres về dạng Decimal (object), đổi sang số trước khi hạ kiểu
+    series = pd.to_numeric(series, errors='coerce')
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast='integer')
+    narrowed = series.astype(np.float32)
+    # Chỉ dùng float32 khi giá trị không đổi, tránh làm tròn số liệu lớn trên biểu đồ
+    if np.array_equal(narrowed.to_numpy(dtype=np.float64), series.to_numpy(dtype=np.float64), equal_nan=True):
+        return narrowed
+    return series
+
+
+def stream_frames(conn, query, params: Optional[Dict[str, Any]] = None,
+                  chunk_size: Optional[int] = None) -> Iterator[pd.DataFrame]:
+    """Đọc kết quả query qua server-side cursor, mỗi lần một chunk đã tối ưu kiểu dữ liệu"""
+    chunk_size = chunk_size or settings.CHART_EXTRACT_CHUNK_SIZE
+    # Đặt option trên câu lệnh: Connection.execution_options của SQLAlchemy 2.0 sửa luôn connection của caller
+    result = conn.execute(query.execution_options(stream_results=True, max_row_buffer=chunk_size), params or {})
+    try:
+        columns = list(result.keys())
+        for rows in result.partitions(chunk_size):
+            yield optimize_dtypes(pd.DataFrame.from_records(rows, columns=columns))
+    finally:
+        result.close()
+
+
+def iter_partitions(chunks: Iterator[pd.DataFrame], keys: Sequence[str]) -> Iterator[Tuple[Tuple, pd.DataFrame]]:
+    """Ghép các chunk (đã sắp xếp theo keys) thành từng partition đầy đủ.
+
+    Nhóm cuối của mỗi chunk có thể còn tiếp ở chunk sau nên được giữ lại; bộ nhớ chỉ
+    cần một chunk cộng một partition.
+    """
+    keys = list(keys)
+    carry = None
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        if carry is not None:
+            # Ghép category khác nhau sẽ thành object, tối ưu lại kiểu sau khi ghép
+            chunk = optimize_dtypes(pd.concat([carry, chunk], ignore_index=True))
+        last = chunk[keys].iloc[-1]
+        tail = (chunk[keys] == last).all(axis=1)
+        carry = chunk[tail]
+        yield from _groups(chunk[~tail], keys)
+    if carry is not None:
+        yield from _groups(carry, keys)
+
+
+def _groups(frame: pd.DataFrame, keys: List[str]) -> Iterator[Tuple[Tuple, pd.DataFrame]]:
+    if frame.empty:
+        return
+    # observed=True: không sinh nhóm rỗng cho các giá trị category không xuất hiện
+    for key, partition in frame.groupby(keys, sort=False, observed=True):
+        partition = partition.reset_index(drop=True)
+        for column in partition.select_dtypes('category').columns:
+            partition[column] = partition[column].cat.remove_unused_categories()
+        yield key, partition
@@ -1,16 +1,23 @@
 import logging
-from typing import List, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import pandas as pd
 from sqlalchemy import create_engine, text
 
 from config.settings import settings
+from src.catalog.chart_specs import (ChartRule, assign_rules, compile_rule_query, create_chart_spec_table,
+                                     indicator_query, load_chart_rules)
+from src.catalog.extract import iter_partitions, stream_frames
 from src.service.dashboard import DashboardService
-from src.service.chart import ChartService
+from src.service.chart import (ChartService, ChartSpec, build_dial_figures, build_dial_grid, render_charts,
+                               row_hashes, spec_hash)
+from src.service.metadata import refresh_metadata
 
 engine = create_engine(settings.database_url)
 target_engine = create_engine(settings.target_database_url)
 
+EMPTY_FRAME = pd.DataFrame()
+
 def list_rp() -> List[str]:
     get_rp = """
     SELECT table_name
@@ -56,21 +63,10 @@ def insert_dashboards(df_dash: pd.DataFrame):
         print("No dashboards to insert.")
         return
     df_dash = df_dash.rename(columns={'report_id': 'id', 'table': 'name', 'report_name': 'description'})
+    dash = DashboardService(target_engine)
     for _, row in df_dash.iterrows():
-        dash = DashboardService(target_engine)
         dash.create_dashboard(row['id'], row['name'], row['description'])
 
-def chart_query(ind_code: str):
-    return f"""
-        SELECT report_id, report_name, bc.prd_id, period_name, org_name, hash_id, ind_name, ind_code, ind_unit, tt4, tt5
-        FROM public.bao_cao_ktxh_huyen_lac_duong_chi_tieu_thang_7753 bc
-        JOIN public.sys_organization o ON bc.org_id = o.id
-        JOIN public.rp_input_grant i ON bc.rp_input_grant_id = i.id
-        JOIN rp_period p ON p.id = i.period_id
-        JOIN rp_report r ON r.id = i.report_id
-        WHERE ind_code = '{ind_code}';
-    """
-
 def add_filter():
     target_conn = target_engine.connect()
 
@@ -80,119 +76,202 @@ def add_filter():
     """
     target_conn.execute(text(add_filter))
     target_conn.commit()
+    refresh_metadata(target_engine)
 
-def create_chi_tieu_thang_charts():
-    source_conn = engine.connect()
+def add_chart_templates():
+    """Tạo bảng template dùng chung và chuyển các biểu đồ cũ sang dạng lưu gọn"""
     target_conn = target_engine.connect()
 
-    dash_id = settings.CHI_TIEU_THANG
+    add_templates = """
+    CREATE TABLE IF NOT EXISTS catalog.chart_templates (
+        id VARCHAR(32) PRIMARY KEY,
+        template JSONB NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE catalog.charts
+    ADD COLUMN IF NOT EXISTS template_id VARCHAR(32) REFERENCES catalog.chart_templates(id);
+    """
+    target_conn.execute(text(add_templates))
+    target_conn.commit()
+    refresh_metadata(target_engine)
 
-    update_filter = """
-        UPDATE catalog.dashboards
-        SET filters = jsonb_build_object('fields', :field)
-        WHERE id = :id
-        """
-    target_conn.execute(text(update_filter), {'field': 'prd_id', 'id': dash_id})
+    migrated = ChartService(target_engine).migrate_templates()
+    print(f"Moved templates out of {migrated} charts")
+
+def add_content_hash():
+    target_conn = target_engine.connect()
+
+    add_hash = """
+    ALTER TABLE catalog.charts
+    ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32);
+    """
+    target_conn.execute(text(add_hash))
     target_conn.commit()
+    refresh_metadata(target_engine)
+
+def add_chart_specs():
+    with target_engine.begin() as target_conn:
+        create_chart_spec_table(target_conn)
+
+def create_chi_tieu_thang_charts():
+    create_report_charts([settings.CHI_TIEU_THANG])
+
+
+def create_report_charts(dashboard_ids: Optional[List[int]] = None, incremental: bool = settings.CHART_INCREMENTAL):
+    """Sinh biểu đồ cho các dashboard báo cáo (mặc định: tất cả) theo quy tắc trong catalog.chart_specs.
 
-    get_table_name = f"""
-        SELECT name, filters
+    incremental: chỉ vẽ lại biểu đồ có dữ liệu/cấu hình thay đổi thay vì truncate và sinh lại toàn bộ.
+    """
+    query = """
+        SELECT id, name, filters
         FROM catalog.dashboards
-        WHERE id = {dash_id}
+        WHERE CAST(:ids AS INTEGER[]) IS NULL OR id = ANY(:ids)
+        ORDER BY id
         """
+    set_default_filter = """
+        UPDATE catalog.dashboards
+        SET filters = jsonb_build_object('fields', :field)
+        WHERE filters IS NULL
+        """
+    with target_engine.connect() as target_conn:
+        target_conn.execute(text(set_default_filter), {'field': 'prd_id'})
+        target_conn.commit()
+        dashboards = target_conn.execute(text(query), {'ids': dashboard_ids}).mappings().fetchall()
+        rules = load_chart_rules(target_conn)
 
-    dashboard_info = pd.read_sql(text(get_table_name), target_conn).iloc[0]
-    table_name = dashboard_info['name']
-    filters = dashboard_info['filters']
+    chart_service = ChartService(target_engine)
+    incremental = incremental and chart_service.hashed
+    # Chỉ truncate khi sinh lại mọi dashboard; với một số dashboard thì xóa biểu đồ của từng dashboard
+    # ngay trong savepoint của nó, các dashboard khác giữ nguyên
+    if not incremental and dashboard_ids is None:
+        chart_service.truncate_charts()
 
-    get_ind_code = f"""
-    SELECT DISTINCT ind_code
-    FROM public.{table_name}
-    """
+    # Cả lượt chạy là một transaction: người đọc luôn thấy bộ biểu đồ cũ cho tới khi commit
+    with engine.connect() as source_conn, target_engine.begin() as target_conn:
+        for dashboard in dashboards:
+            filter_col = (dashboard['filters'] or {}).get('fields', 'prd_id')
+            try:
+                # Lỗi ở một dashboard chỉ rollback savepoint của dashboard đó
+                with target_conn.begin_nested():
+                    specs = generate_chart_specs(source_conn, dashboard['id'], dashboard['name'], filter_col, rules)
+                    if incremental:
+                        saved, skipped, deleted = sync_dashboard_charts(chart_service, target_conn, dashboard['id'], specs)
+                        print(f"Dashboard {dashboard['id']}: saved {saved}, unchanged {skipped}, deleted {deleted} charts")
+                    else:
+                        if dashboard_ids is not None:
+                            chart_service.delete_dashboard_charts(dashboard['id'], target_conn)
+                        records = render_charts(specs, backend=chart_service.backend)
+                        saved = chart_service.save_charts(records, conn=target_conn)
+                        print(f"Saved {saved} charts for dashboard {dashboard['id']}")
+            except Exception as e:
+                source_conn.rollback()
+                logging.error(f"Cannot generate charts for dashboard {dashboard['id']}: {e}")
+
+
+def sync_dashboard_charts(chart_service: ChartService, target_conn, dash_id: int,
+                          specs: Iterator[ChartSpec]) -> Tuple[int, int, int]:
+    """Chỉ vẽ và ghi các biểu đồ có content_hash thay đổi, xóa biểu đồ không còn được sinh ra"""
+    existing = chart_service.get_content_hashes(dash_id, target_conn)
+    seen = set()
+    skipped = 0
+
+    def changed_specs() -> Iterator[ChartSpec]:
+        nonlocal skipped
+        for spec in specs:
+            spec.content_hash = spec.content_hash or spec_hash(spec, chart_service.backend)
+            seen.add(spec.row_id)
+            if existing.get(spec.row_id) == spec.content_hash:
+                skipped += 1
+                continue
+            yield spec
 
-    list_ind_code = pd.read_sql(text(get_ind_code), source_conn)['ind_code'].tolist()
-    filter_col = filters['fields']
+    saved = chart_service.save_charts(render_charts(changed_specs(), backend=chart_service.backend),
+                                     conn=target_conn)
+    deleted = chart_service.delete_charts(dash_id, existing.keys() - seen, target_conn)
+    return saved, skipped, deleted
 
-    get_filter_value = f"""
-    SELECT DISTINCT {filter_col}
-    FROM public.{table_name}
-    ORDER BY {filter_col}
+
+def generate_chart_specs(source_conn, dash_id: int, table_name: str, filter_col: str,
+                         rules: List[ChartRule]) -> Iterator[ChartSpec]:
+    """Mỗi quy tắc chạy một query đã gộp sẵn trong database, đọc dần từng partition (ind_code, kỳ báo cáo)"""
+    ind_codes = [row[0] for row in source_conn.execute(indicator_query(table_name))]
+    for rule, codes in assign_rules(rules, dash_id, ind_codes):
+        # Đọc theo chunk qua server-side cursor; query đã sắp theo (ind_code, kỳ) nên partition liền nhau
+        chunks = stream_frames(source_conn, compile_rule_query(rule, table_name, filter_col), {'ind_codes': codes})
+        for (_, filter_value), partition in iter_partitions(chunks, ['ind_code', 'filter_value']):
+            # Khóa groupby là kiểu numpy, đổi sang kiểu Python để ghi được vào JSONB
+            filter_value = filter_value.item() if hasattr(filter_value, 'item') else filter_value
+            yield from build_rule_charts(rule, dash_id, partition, filter_col, filter_value)
+
+
+def build_rule_charts(rule: ChartRule, dash_id: int, data: pd.DataFrame, filter_col: str,
+                      filter_value) -> List[ChartSpec]:
+    filters = {
+        filter_col: filter_value,
+    }
+    if rule.per_row:
+        return build_row_charts(rule, dash_id, data, filters)
+
+    title = data['ind_name'].iloc[0]
+    row_id = data['group_id'].iloc[0]
+    config = {**rule.config, 'unit': data['ind_unit'].iloc[0]}
+    # Vị trí trong mảng giá trị của figure theo hash_id dòng gốc, để syncer sửa trực tiếp khi dòng đổi
+    if 'member_ids' in data.columns:
+        config['members'] = {member: pos for pos, ids in enumerate(data['member_ids']) for member in ids}
+        data = data.drop(columns='member_ids')
+    else:
+        config['members'] = {member: pos for pos, member in enumerate(data['hash_id'])}
+    config['value_columns'] = rule.value_columns[:1] if rule.chart_type == 'pie' else list(rule.value_columns)
+    if rule.aggregation:
+        config['aggregation'] = rule.aggregation
+    if rule.chart_type == 'pie':
+        config.update(names_column=rule.x_column, values_column=rule.value_columns[0])
+    elif len(rule.value_columns) == 1:
+        config.update(x_column=rule.x_column, y_column=rule.value_columns[0])
+    else:
+        # Nhiều cột giá trị: mỗi cột một nhóm màu
+        data = pd.melt(
+            data,
+            id_vars=[rule.x_column],
+            value_vars=rule.value_columns,
+            var_name='Metric',
+            value_name='Value'
+        )
+        config.update(x_column=rule.x_column, y_column='Value', color_column='Metric')
+    return [ChartSpec(dash_id, row_id, title, title, rule.chart_type, data, config, filters)]
+
+
+def build_row_charts(rule: ChartRule, dash_id: int, data: pd.DataFrame,
+                     filters: Dict[str, Any]) -> List[ChartSpec]:
+    """Đồng hồ theo từng dòng của partition, dựng một lượt từ các mảng cột.
+
+    config {'grid': true} của quy tắc: gộp cả partition thành một figure dạng lưới.
     """
-    list_filter_value = pd.read_sql(text(get_filter_value), source_conn)[filter_col].tolist()
-    # print(filter_col)
+    value_col, threshold_col = (rule.value_columns * 2)[:2]
+    titles = data[rule.x_column].tolist()
+    values = data[value_col].tolist()
+    thresholds = data[threshold_col].tolist()
 
-    chart_service = ChartService(target_engine)
-    chart_service.truncate_charts()
-    for ind_code in list_ind_code:
-        if ind_code == 'Bhxh1':
-            query = chart_query(ind_code)
-            data = pd.read_sql(query, source_conn)
-            for filter_value in list_filter_value:
-                filtered_data = data[data[filter_col] == filter_value]
-                for _, row in filtered_data.iterrows():
-                    title = row['org_name']
-                    config = {
-                        'value_column': row['tt5'],
-                        'threshold_column': row['tt4'],
-                    }
-                    filters = {
-                        filter_col: filter_value,
-                    }
-                    single_row_data = pd.DataFrame([row])
-                    res = chart_service.create_chart(single_row_data, 'dial', title, config, filters)
-                    chart_service.save_chart(dash_id, row['hash_id'], row["ind_name"], row["org_name"],
-                                             'dial', res['json_data'], res['config'], res['filters'])
-
-        elif ind_code == 'Bhxh3':
-            query = chart_query(ind_code)
-            data = pd.read_sql(query, source_conn)
-            for filter_value in list_filter_value:
-                filtered_data = data[data[filter_col] == filter_value]
-                title = filtered_data['ind_name'].iloc[0]
-                row_id = filtered_data['hash_id'].iloc[0]
-                config = {
-                    'orientation': 'h',
-                    'x_column': 'org_name',
-                    'y_column': 'tt5',
-                    'x_title': 'Phòng ban',
-                    'y_title': 'Cư dân',
-                    'unit': filtered_data['ind_unit'].iloc[0],
-                }
-                filters = {
-                    filter_col: filter_value,
-                }
-                res = chart_service.create_chart(filtered_data, 'bar', title, config, filters)
-                chart_service.save_chart(dash_id, row_id , title, title,'bar', res['json_data'], res['config'], res['filters'])
-
-        else:
-            query = chart_query(ind_code)
-            data = pd.read_sql(query, source_conn)
-            for filter_value in list_filter_value:
-                filtered_data = data[data[filter_col] == filter_value]
-                data_melt = pd.melt(
-                    filtered_data,
-                    id_vars=['org_name'],
-                    value_vars=['tt5', 'tt4'],
-                    var_name='Metric',
-                    value_name='Value'
-                )
-                title = filtered_data['ind_name'].iloc[0]
-                row_id = filtered_data['hash_id'].iloc[0]
-                config = {
-                    'orientation': 'v',
-                    'x_column': 'org_name',
-                    'y_column': 'Value',
-                    'color_column': 'Metric',
-                    'barmode': 'group',
-                    'x_title': 'Phòng ban',
-                    'y_title': 'Giá trị',
-                    'unit': filtered_data['ind_unit'].iloc[0],
-                }
-                filters = {
-                    filter_col: filter_value,
-                }
-                res = chart_service.create_chart(data_melt, 'bar', title, config, filters)
-                chart_service.save_chart(dash_id, row_id, title, title, 'bar', res['json_data'], res['config'], res['filters'])
+    if rule.config.get('grid'):
+        title = data['ind_name'].iloc[0]
+        figure = build_dial_grid(titles, values, thresholds, title, rule.config.get('grid_columns', 4))
+        return [ChartSpec(dash_id, data['group_id'].iloc[0], title, title, rule.chart_type, data,
+                          dict(rule.config), filters, figure=figure)]
+
+    figures = build_dial_figures(titles, values, thresholds)
+    hashes = row_hashes(data, rule.chart_type, rule.x_column, rule.value_columns, rule.config, filters)
+    charts = []
+    for row_id, name, title, value, threshold, figure, content_hash in zip(
+            data['hash_id'].tolist(), data['ind_name'].tolist(), titles, values, thresholds, figures, hashes):
+        # NaN không ghi được vào JSONB
+        config = {
+            'value_column': None if pd.isna(value) else value,
+            'threshold_column': None if pd.isna(threshold) else threshold,
+        }
+        # Figure đã dựng sẵn nên không cần DataFrame riêng cho từng dòng
+        charts.append(ChartSpec(dash_id, row_id, name, title, rule.chart_type, EMPTY_FRAME, config, filters,
+                                content_hash=content_hash, figure=figure))
+    return charts
 
 
 if __name__ == "__main__":
@@ -200,4 +279,7 @@ if __name__ == "__main__":
     df_rp = dashboard_info(rp_tables)
     insert_dashboards(df_rp)
     add_filter()
-    create_chi_tieu_thang_charts()
\ No newline at end of file
+    add_chart_templates()
+    add_chart_specs()
+    add_content_hash()
+    create_report_charts()
\ No newline at end of file
@@ -0,0 +1,81 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+from src.utils.pg_conn import PostgresConn
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def stage_timer(timings: Dict[str, float], stage: str):
+    """Cộng dồn thời gian chạy (giây) của một stage vào timings"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.monotonic() - start
+
+
+def add_stage_timings_column(conn: PostgresConn) -> None:
+    conn.execute("""
+        ALTER TABLE catalog.metadata_jobs
+        ADD COLUMN IF NOT EXISTS stage_timings JSONB;
+    """)
+
+
+class HarvestJob:
+    """Ghi lại tiến trình một lần thu thập metadata vào catalog.metadata_jobs"""
+
+    def __init__(self, conn: PostgresConn, job_name: str = "collect_metadata",
+                 database_name: Optional[str] = None):
+        self.conn = conn
+        self.job_name = job_name
+        self.database_name = database_name
+        self.id = None
+        self.tables_processed = 0
+        self.fields_processed = 0
+        self.stage_timings: Dict[str, Dict[str, float]] = {}
+
+    def start(self) -> None:
+        try:
+            add_stage_timings_column(self.conn)
+            self.id = self.conn.select("""
+                INSERT INTO catalog.metadata_jobs (job_name, datasource, database_name, status, start_time)
+                VALUES (%s, %s, %s, 'RUNNING', %s)
+                RETURNING id;
+            """, (self.job_name, self.conn.get_datasource(), self.database_name, datetime.now()))[0][0]
+            self.conn.get_conn().commit()
+            logger.info("Started metadata job %s", self.id)
+        except Exception as e:
+            logger.error(f"Cannot create metadata job: {e}")
+
+    def record(self, database: str, timings: Dict[str, float], tables: int = 0, fields: int = 0) -> None:
+        """Cộng số bảng/field và thời gian các stage của một database, rồi cập nhật dòng job"""
+        db_timings = self.stage_timings.setdefault(database, {})
+        for stage, seconds in timings.items():
+            db_timings[stage] = round(db_timings.get(stage, 0.0) + seconds, 3)
+        self.tables_processed += tables
+        self.fields_processed += fields
+        self._update()
+
+    def finish(self, error: Optional[str] = None) -> None:
+        self._update(status="FAILED" if error else "SUCCESS", error=error, end_time=datetime.now())
+
+    def _update(self, status: str = "RUNNING", error: Optional[str] = None,
+                end_time: Optional[datetime] = None) -> None:
+        if self.id is None:
+            return
+        try:
+            self.conn.execute("""
+                UPDATE catalog.metadata_jobs
+                SET status = %s, end_time = %s, tables_processed = %s, fields_processed = %s,
+                    error_message = %s, stage_timings = %s
+                WHERE id = %s;
+            """, (status, end_time, self.tables_processed, self.fields_processed,
+                  error, json.dumps(self.stage_timings), self.id))
+        except Exception as e:
+            logger.error(f"Cannot update metadata job {self.id}: {e}")
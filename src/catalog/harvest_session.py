@@ -0,0 +1,46 @@
+import logging
+import threading
+from typing import Dict, Tuple
+
+from src.utils.pg_conn import PostgresConn
+
+logger = logging.getLogger(__name__)
+
+
+class HarvestSession:
+    """Giữ một kết nối cho mỗi database trong suốt một lần thu thập metadata"""
+
+    def __init__(self, target_db: str = "debezium"):
+        self.target_db = target_db
+        self.connections_opened = 0
+        self._conns: Dict[Tuple[str, str], PostgresConn] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_conn(self, dbtype: str, database: str) -> PostgresConn:
+        key = (dbtype, database)
+        with self._lock:
+            conn = self._conns.get(key)
+            if conn is None or conn.get_conn().closed:
+                conn = PostgresConn(dbtype, db=database)
+                self._conns[key] = conn
+                self.connections_opened += 1
+            return conn
+
+    def source(self, database: str = "postgres") -> PostgresConn:
+        return self.get_conn("source", database)
+
+    def target(self) -> PostgresConn:
+        return self.get_conn("target", self.target_db)
+
+    def close(self):
+        with self._lock:
+            for conn in self._conns.values():
+                conn.close()
+            self._conns.clear()
+        logger.info("Harvest session opened %s connections", self.connections_opened)
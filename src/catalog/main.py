@@ -1,35 +1,222 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
+from config.settings import settings
 from src.catalog.catalog_fields_info import *
 from src.catalog.catalog_tables_info import *
+from src.catalog.catalog_profiles_info import FieldProfile, create_field_profile_table, get_field_profiles, save_field_profiles
+from src.catalog.harvest_job import HarvestJob, stage_timer
+from src.catalog.harvest_session import HarvestSession
+from src.catalog.sampling import SamplingPolicy, get_relation_columns, sample_relation
 
 
-def collect_metadata():
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    logger.info(f"Collecting table metadata at {timestamp}")
+@dataclass
+class DatabaseHarvestResult:
+    """Kết quả thu thập metadata của một database"""
+    database: str
+    status: str = "SUCCESS"
+    tables: List[TableMetadata] = field(default_factory=list)
+    table_fields: Dict[str, List[FieldMetadata]] = field(default_factory=dict)
+    profiles: List[FieldProfile] = field(default_factory=list)
+    seen_ids: List[str] = field(default_factory=list)
+    skipped: int = 0
+    timings: Dict[str, float] = field(default_factory=dict)
+    duration: float = 0.0
+    error: Optional[str] = None
+
+
+def statistics_policy() -> StatisticsPolicy:
+    return StatisticsPolicy(
+        mode=settings.HARVEST_ANALYZE_MODE,
+        budget=settings.HARVEST_ANALYZE_BUDGET,
+        mod_ratio=settings.HARVEST_ANALYZE_MOD_RATIO,
+    )
 
-    databases = describe_databases()
 
-    all_tables = []
-    all_table_fields = {}
-    for database in databases:
-        logger.info(f"Processing database: {database[0]}")
-        tables = get_table_metadata(database[0])
+def sampling_policy() -> SamplingPolicy:
+    return SamplingPolicy(
+        timeout_ms=settings.HARVEST_SAMPLE_TIMEOUT_MS,
+        max_value_length=settings.HARVEST_SAMPLE_MAX_LENGTH,
+        max_view_cost=settings.HARVEST_SAMPLE_MAX_VIEW_COST,
+    )
+
+
+def harvest_database(database: str, session: HarvestSession, bulk: bool = True,
+                     stop: Optional[threading.Event] = None,
+                     result: Optional[DatabaseHarvestResult] = None,
+                     known: Optional[Dict[str, Tuple]] = None) -> Tuple[List[TableMetadata], Dict[str, List[FieldMetadata]]]:
+    """Thu thập metadata bảng và trường của một database"""
+    timings = result.timings if result is not None else {}
+    conn = session.source(database)
+    with stage_timer(timings, "listing"):
+        tables = get_table_metadata(database, conn, statistics_policy(), stop)
+        # get_table_metadata nuốt lỗi của câu lệnh bị hủy và trả về [], không được coi là database rỗng
+        if stop is not None and stop.is_set():
+            raise TimeoutError(f"Harvest of database {database} timed out")
 
         if not tables:
-            logger.warning(f"No tables found in database: {database[0]}")
-            continue
+            logger.warning(f"No tables found in database: {database}")
+            return [], {}
+
+        seen_tables = tables
+        if result is not None:
+            result.seen_ids = [table.id for table in tables]
 
-        all_tables.extend(tables)
+        if known is not None:
+            tables, skipped = select_changed_tables(tables, known, datetime.now())
+            if result is not None:
+                result.skipped = skipped
 
+    with stage_timer(timings, "sampling"):
+        policy = sampling_policy()
+        columns = get_relation_columns(conn, [table.oid for table in tables])
+        sample_data = {}
         for table in tables:
-            sample_data = get_sample_data(database[0], table.schema, table.name)
-            fields = get_field_metadata(database[0], table.oid, sample_data)
+            if stop is not None and stop.is_set():
+                raise TimeoutError(f"Harvest of database {database} timed out")
+            sample_data[table.oid] = sample_relation(conn, table, columns.get(table.oid, []), policy)
+
+    with stage_timer(timings, "field_harvest"):
+        table_fields = {}
+        if bulk:
+            table_oids = [table.oid for table in tables] if known is not None else None
+            fields_by_oid = get_bulk_field_metadata(database, sample_data, conn, table_oids)
+            for table in tables:
+                table_fields[table.id] = fields_by_oid.get(table.oid, [])
+        else:
+            for table in tables:
+                if stop is not None and stop.is_set():
+                    raise TimeoutError(f"Harvest of database {database} timed out")
+                table_fields[table.id] = get_field_metadata(database, table.oid, sample_data[table.oid], conn)
+
+    if stop is not None and stop.is_set():
+        raise TimeoutError(f"Harvest of database {database} timed out")
+
+    if result is not None and settings.HARVEST_PROFILE:
+        with stage_timer(timings, "profiling"):
+            # Bảng được bỏ qua đã có field_origin; bảng vừa thu thập chỉ lấy các field đã có metadata
+            harvested_fields = {
+                field_id(table_id, f.name)
+                for table_id, fields in table_fields.items() for f in fields
+            }
+            result.profiles = [
+                profile for profile in get_field_profiles(database, seen_tables, conn)
+                if profile.table_id not in table_fields or profile.id in harvested_fields
+            ]
+
+    return tables, table_fields
+
+
+def _harvest_worker(database: str, session: HarvestSession, bulk: bool,
+                    timeout: Optional[float], known: Optional[Dict[str, Tuple]]) -> DatabaseHarvestResult:
+    stop = threading.Event()
+
+    def expire():
+        # Đánh dấu hết giờ và hủy câu lệnh đang chạy trên database này
+        stop.set()
+        session.source(database).get_conn().cancel()
+
+    timer = threading.Timer(timeout, expire) if timeout else None
+    start = time.monotonic()
+    result = DatabaseHarvestResult(database=database)
+    try:
+        if timer:
+            timer.start()
+        logger.info(f"Processing database: {database}")
+        result.tables, result.table_fields = harvest_database(database, session, bulk, stop, result, known)
+    except TimeoutError as e:
+        result.status = "TIMEOUT"
+        result.error = str(e)
+    except Exception as e:
+        result.status = "FAILED"
+        result.error = str(e)
+    finally:
+        if timer:
+            timer.cancel()
+        result.duration = time.monotonic() - start
+
+    if result.status != "SUCCESS":
+        result.tables, result.table_fields, result.profiles = [], {}, []
+        logger.error("Database %s: %s (%s)", database, result.status, result.error)
+    return result
+
+
+def log_summary(results: List[DatabaseHarvestResult]) -> None:
+    logger.info("Harvest summary:")
+    for res in sorted(results, key=lambda r: r.database):
+        n_tables = len(res.tables)
+        n_fields = sum(len(f) for f in res.table_fields.values())
+        logger.info("  %-30s %-8s tables=%-6s skipped=%-6s fields=%-7s %.2fs",
+                    res.database, res.status, n_tables, res.skipped, n_fields, res.duration)
+
+
+def save_database_result(res: DatabaseHarvestResult, timestamp: str, session: HarvestSession,
+                         incremental: bool = False) -> None:
+    """Ghi metadata của một database vào catalog qua các hàm upsert sẵn có"""
+    with stage_timer(res.timings, "table_save"):
+        save_table_metadata(res.tables, timestamp, session.target(), mark_harvested=incremental)
+    with stage_timer(res.timings, "field_save"):
+        save_field_metadata(res.table_fields, timestamp, session.target())
+    if res.profiles:
+        with stage_timer(res.timings, "profile_save"):
+            save_field_profiles(res.profiles, timestamp, session.target())
+
+
+def collect_metadata(bulk: bool = True, workers: int = settings.HARVEST_WORKERS,
+                     db_timeout: Optional[float] = settings.HARVEST_DB_TIMEOUT,
+                     incremental: bool = settings.HARVEST_INCREMENTAL):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    logger.info(f"Collecting table metadata at {timestamp}")
+
+    with HarvestSession() as session:
+        job = HarvestJob(session.target())
+        job.start()
+        try:
+            add_harvest_columns(session.target())
+            create_field_profile_table(session.target())
+            known = get_known_tables(session.target()) if incremental else None
+
+            databases = [database[0] for database in describe_databases(session.source())]
+
+            results = []
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                futures = [
+                    executor.submit(_harvest_worker, database, session, bulk, db_timeout, known)
+                    for database in databases
+                ]
+                # Ghi từng database ngay khi worker xong, trên thread chính
+                for future in as_completed(futures):
+                    res = future.result()
+                    results.append(res)
+                    if res.status == "SUCCESS":
+                        try:
+                            save_database_result(res, timestamp, session, incremental)
+                        except Exception as e:
+                            # Lỗi ghi của một database không dừng các database khác
+                            res.status, res.error = "FAILED", f"save failed: {e}"
+                            res.tables, res.table_fields, res.profiles = [], {}, []
+                            logger.error("Database %s: %s (%s)", res.database, res.status, res.error)
+                    job.record(res.database, res.timings, len(res.tables),
+                               sum(len(f) for f in res.table_fields.values()))
+
+            if incremental:
+                # Bỏ qua database không đọc được bảng nào để tránh expire nhầm toàn bộ
+                expire_missing_tables(
+                    {res.database: res.seen_ids for res in results if res.status == "SUCCESS" and res.seen_ids},
+                    timestamp, session.target()
+                )
 
-            all_table_fields[table.id] = fields
+            log_summary(results)
 
-    save_table_metadata(all_tables, timestamp)
-    save_field_metadata(all_table_fields, timestamp)
+            failed = [f"{res.database}: {res.status} ({res.error})" for res in results if res.status != "SUCCESS"]
+            job.finish("; ".join(failed) if failed else None)
+        except Exception as e:
+            job.finish(str(e))
+            raise
 
 def main():
     collect_metadata()
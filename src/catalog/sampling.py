@@ -0,0 +1,104 @@
+import json
+import logging
+from dataclasses import dataclass
+from typing import List, Tuple, Dict
+
+from psycopg2 import sql as pgsql
+
+from src.catalog.catalog_tables_info import TableMetadata
+from src.utils.pg_conn import PostgresConn
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+@dataclass
+class SamplingPolicy:
+    """Giới hạn chi phí khi lấy dữ liệu mẫu"""
+    limit: int = 3
+    timeout_ms: int = 2000              # statement_timeout cho mỗi câu lấy mẫu
+    max_value_length: int = 200         # Cắt giá trị dài ngay trên server
+    tablesample_min_rows: int = 10000   # Bảng lớn hơn ngưỡng này dùng TABLESAMPLE SYSTEM
+    max_view_cost: float = 100000.0     # View có cost ước tính lớn hơn sẽ bị bỏ qua
+
+def get_relation_columns(conn: PostgresConn, table_oids: List[int]) -> Dict[int, List[Tuple[int, str]]]:
+    """Lấy (attnum, tên cột) của các relation trong một query"""
+    sql = """
+        SELECT a.attrelid, a.attnum, a.attname
+        FROM pg_attribute a
+        WHERE a.attrelid = ANY(%s::oid[])
+          AND a.attnum > 0
+          AND NOT a.attisdropped
+        ORDER BY a.attrelid, a.attnum;
+    """
+    columns: Dict[int, List[Tuple[int, str]]] = {}
+    for table_oid, attnum, attname in conn.select(sql, (table_oids,)):
+        columns.setdefault(table_oid, []).append((attnum, attname))
+    return columns
+
+def estimate_cost(conn: PostgresConn, relation: pgsql.Composable) -> float:
+    """Cost ước tính của planner khi đọc toàn bộ relation"""
+    query = pgsql.SQL("EXPLAIN (FORMAT JSON) SELECT * FROM {}").format(relation)
+    plan = conn.select(query)[0][0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Total Cost']
+
+def _run_sample(conn: PostgresConn, query: pgsql.Composable, timeout_ms: int) -> List[Tuple]:
+    # statement_timeout chỉ áp dụng trong transaction của câu lấy mẫu
+    conn.select("SELECT set_config('statement_timeout', %s, true);", (str(timeout_ms),))
+    rows = conn.select(query)
+    conn.get_conn().commit()
+    return rows
+
+def sample_relation(conn: PostgresConn, table: TableMetadata, columns: List[Tuple[int, str]],
+                    policy: SamplingPolicy) -> List[Tuple]:
+    """Lấy dữ liệu mẫu của một relation, mỗi dòng được sắp theo attnum như SELECT *"""
+    if not columns:
+        return []
+
+    relation = pgsql.Identifier(table.schema, table.name)
+    try:
+        if table.type == 'view':
+            cost = estimate_cost(conn, relation)
+            if cost > policy.max_view_cost:
+                logger.info("Skip sampling view %s.%s (estimated cost %.0f)", table.schema, table.name, cost)
+                return []
+
+        select_list = pgsql.SQL(', ').join(
+            pgsql.SQL("left({}::text, {})").format(pgsql.Identifier(name), pgsql.Literal(policy.max_value_length))
+            for _, name in columns
+        )
+        plain_query = pgsql.SQL("SELECT {} FROM {} LIMIT {}").format(
+            select_list, relation, pgsql.Literal(policy.limit)
+        )
+
+        rows = []
+        if table.type != 'view' and table.rows > policy.tablesample_min_rows:
+            percent = min(100.0, 100.0 * policy.limit * 10 / table.rows)
+            sampled_query = pgsql.SQL("SELECT {} FROM {} TABLESAMPLE SYSTEM ({}) LIMIT {}").format(
+                select_list, relation, pgsql.Literal(percent), pgsql.Literal(policy.limit)
+            )
+            rows = _run_sample(conn, sampled_query, policy.timeout_ms)
+
+        if not rows:
+            rows = _run_sample(conn, plain_query, policy.timeout_ms)
+
+    except Exception as e:
+        logger.warning(f"Cannot extract data from {table.schema}.{table.name}: {str(e)}")
+        # Transaction lỗi phải được rollback, nếu không relation tiếp theo sẽ gặp InFailedSqlTransaction
+        if not conn.get_conn().closed:
+            conn.get_conn().rollback()
+        return []
+
+    # Đặt giá trị về đúng vị trí attnum, cột đã bị drop để None
+    width = columns[-1][0]
+    samples = []
+    for row in rows:
+        sample_row = [None] * width
+        for (attnum, _), value in zip(columns, row):
+            sample_row[attnum - 1] = value
+        samples.append(tuple(sample_row))
+    return samples
@@ -0,0 +1,87 @@
+import logging
+from dataclasses import dataclass
+from typing import Optional, List
+
+from src.utils.pg_conn import PostgresConn
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+@dataclass
+class SearchResult:
+    """Một kết quả tìm kiếm trong catalog (bảng hoặc trường)"""
+    kind: str
+    table_id: str
+    field_id: Optional[str]
+    database: str
+    schema: str
+    tablename: str
+    field: Optional[str]
+    business_term: Optional[str]
+    score: float
+
+def create_search_index(conn: PostgresConn) -> None:
+    """Tạo extension, hàm search_text và index trigram cho target đã khởi tạo trước đó"""
+    conn.execute("""
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE EXTENSION IF NOT EXISTS unaccent;
+
+        CREATE OR REPLACE FUNCTION catalog.search_text(name TEXT, description TEXT)
+        RETURNS TEXT AS $$
+            SELECT lower(public.unaccent('public.unaccent'::regdictionary, concat_ws(' ', name, description)));
+        $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+        CREATE INDEX IF NOT EXISTS idx_table_origin_search ON catalog.table_origin
+            USING gin (catalog.search_text(tablename, business_term) gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_field_origin_search ON catalog.field_origin
+            USING gin (catalog.search_text(field, business_term) gin_trgm_ops);
+    """)
+
+def search_catalog(term: str, limit: int = 20, kinds: Optional[List[str]] = None,
+                   conn: Optional[PostgresConn] = None) -> List[SearchResult]:
+    """Tìm bảng và trường theo tên, business term và mô tả cột, xếp hạng theo độ tương đồng"""
+    kinds = kinds or ['table', 'field']
+    own_conn = conn is None
+    conn = conn or PostgresConn("target", db="debezium")
+    try:
+        # Điều kiện WHERE giữ nguyên biểu thức catalog.search_text(...) để dùng được index GIN trigram
+        sql = """
+        WITH q AS (
+            SELECT catalog.search_text(%(term)s, NULL) AS term
+        )
+        SELECT * FROM (
+            SELECT 'table' AS kind, t.id, NULL AS field_id, t.database, t.schema, t.tablename,
+                   NULL AS field, t.business_term,
+                   word_similarity(q.term, catalog.search_text(t.tablename, t.business_term)) AS score
+            FROM catalog.table_origin t, q
+            WHERE 'table' = ANY(%(kinds)s)
+              AND NOT t.expire
+              AND (q.term <%% catalog.search_text(t.tablename, t.business_term)
+                   OR catalog.search_text(t.tablename, t.business_term) LIKE '%%' || q.term || '%%')
+            UNION ALL
+            SELECT 'field' AS kind, t.id, f.id, t.database, t.schema, t.tablename,
+                   f.field, f.business_term,
+                   word_similarity(q.term, catalog.search_text(f.field, f.business_term)) AS score
+            FROM catalog.field_origin f
+            JOIN catalog.table_origin t ON t.id = f.table_id, q
+            WHERE 'field' = ANY(%(kinds)s)
+              AND NOT t.expire
+              AND (q.term <%% catalog.search_text(f.field, f.business_term)
+                   OR catalog.search_text(f.field, f.business_term) LIKE '%%' || q.term || '%%')
+        ) r
+        ORDER BY score DESC, kind DESC, tablename, field
+        LIMIT %(limit)s;
+        """
+
+        result = conn.select(sql, {'term': term, 'kinds': kinds, 'limit': limit})
+        return [SearchResult(*row) for row in result]
+
+    except Exception as e:
+        logger.warning("Cannot search catalog: %s", e)
+        return []
+    finally:
+        if own_conn:
+            conn.close()
@@ -8,6 +8,7 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from config.settings import settings
+from src.service.chart import load_templates, rehydrate_figure
 from src.utils.chatbot import *
 
 # Streamlit page config
@@ -53,12 +54,23 @@ def load_charts(dashboard_id):
                    config, \
                    filters, \
                    json_data, \
+                   template_id, \
                    created_at
             FROM catalog.charts
             WHERE dashboard_id = %(dashboard_id)s
             ORDER BY created_at DESC \
             """
-    return pd.read_sql(query, engine, params={'dashboard_id': 7753})
+    charts = pd.read_sql(query, engine, params={'dashboard_id': 7753})
+
+    # Template Plotly lưu riêng trong catalog.chart_templates: đọc mỗi template một lần rồi gắn lại
+    with engine.connect() as conn:
+        templates = load_templates(conn, charts['template_id'].dropna().unique().tolist())
+    if templates:
+        charts['json_data'] = [
+            rehydrate_figure(json_data, templates.get(template_id))
+            for json_data, template_id in zip(charts['json_data'], charts['template_id'])
+        ]
+    return charts
 
 
 # Create plotly figure from json data
@@ -1,21 +1,225 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import *
+import hashlib
 import json
-from sqlalchemy import create_engine, MetaData, Table, text
+from sqlalchemy import select, text
+import numpy as np
 import pandas as pd
+import math
+from functools import lru_cache
 import plotly.graph_objects as go
 import plotly.express as px
+import plotly.io as pio
 from sqlalchemy.dialects.postgresql import insert
 
 from config.settings import settings
+from src.service.metadata import get_table
+
+
+@dataclass
+class ChartSpec:
+    """Mọi thứ cần để vẽ và lưu một biểu đồ, có thể pickle sang process khác"""
+    dashboard_id: int
+    row_id: str
+    name: str
+    title: str
+    chart_type: str
+    data: pd.DataFrame
+    config: Dict[str, Any] = field(default_factory=dict)
+    filters: Optional[Dict[str, Any]] = None
+    content_hash: Optional[str] = None
+    # Figure đã dựng sẵn (ví dụ build_dial_figures): render_chart dùng luôn, không vẽ lại
+    figure: Optional[Dict[str, Any]] = None
+
+
+def spec_hash(spec: ChartSpec, backend: Optional[str] = None) -> str:
+    """Mã băm của dữ liệu partition và mọi tham số vẽ: trùng mã băm thì biểu đồ không đổi"""
+    digest = hashlib.md5()
+    digest.update(json.dumps(
+        [backend or settings.CHART_BACKEND, spec.name, spec.title, spec.chart_type, spec.config, spec.filters,
+         list(map(str, spec.data.columns))],
+        sort_keys=True, default=str, ensure_ascii=False
+    ).encode())
+    digest.update(pd.util.hash_pandas_object(_hash_frame(spec.data), index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def _hash_frame(data: pd.DataFrame) -> pd.DataFrame:
+    # hash_pandas_object phụ thuộc dtype: float32/int8 và float64 cùng giá trị cho mã băm khác nhau.
+    # Kiểu hạ xuống được chọn theo từng chunk đọc, nên đưa mọi cột số về float64 trước khi băm
+    numeric = [column for column, dtype in data.dtypes.items()
+               if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+               and dtype != np.float64]
+    if not numeric:
+        return data
+    return data.astype({column: np.float64 for column in numeric})
+
+
+@lru_cache(maxsize=None)
+def _template_json(name: str) -> Dict[str, Any]:
+    return pio.templates[name].to_plotly_json()
+
+
+def _column_values(series: pd.Series) -> List[Any]:
+    # Giống fig.to_json(): NaN/None thành null, kiểu numpy thành kiểu Python
+    return [None if isinstance(v, float) and math.isnan(v) else v
+            for v in series.astype(object).where(series.notna(), None).tolist()]
+
+
+def _scalar(value: Any) -> Any:
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _dial_trace(title: Any, value: Any, threshold: Any) -> Dict[str, Any]:
+    return {
+        'domain': {'x': [0, 1], 'y': [0, 1]},
+        'gauge': {
+            'axis': {'range': [0, 100]},
+            'bar': {'color': 'darkblue'},
+            'bgcolor': 'white',
+            'bordercolor': 'gray',
+            'borderwidth': 2,
+            'steps': [
+                {'color': 'lightgray', 'range': [0, 25]},
+                {'color': 'gray', 'range': [25, 75]},
+                {'color': 'darkgray', 'range': [75, 100]},
+            ],
+            'threshold': {'line': {'color': 'red', 'width': 4}, 'thickness': 0.75, 'value': _scalar(threshold)},
+        },
+        'mode': 'gauge+number',
+        'title': {'text': title},
+        'value': _scalar(value),
+        'type': 'indicator',
+    }
+
+
+def _dial_figure(title: Any, value: Any, threshold: Any) -> Dict[str, Any]:
+    return {
+        'data': [_dial_trace(title, value, threshold)],
+        'layout': {
+            'template': _template_json('plotly_white'),
+            'annotations': [{
+                'font': {'color': 'red', 'size': 14},
+                'showarrow': False,
+                'text': f"Target: {threshold}",
+                'x': 0.5,
+                'xref': 'paper',
+                'y': -0.15,
+                'yref': 'paper',
+            }],
+            'height': 400,
+        },
+    }
+
+
+def build_dial_figures(titles: Sequence[Any], values: Sequence[Any],
+                       thresholds: Sequence[Any]) -> List[Dict[str, Any]]:
+    """Figure JSON của nhiều đồng hồ từ các mảng cột, không dựng DataFrame hay go.Figure cho từng dòng"""
+    return [_dial_figure(title, value, threshold) for title, value, threshold in zip(titles, values, thresholds)]
+
+
+def build_dial_grid(titles: Sequence[Any], values: Sequence[Any], thresholds: Sequence[Any],
+                    title: Optional[str] = None, columns: int = 4) -> Dict[str, Any]:
+    """Gộp nhiều đồng hồ vào một figure dạng lưới (layout.grid), mỗi ô một chỉ tiêu"""
+    traces = []
+    for idx, (cell_title, value, threshold) in enumerate(zip(titles, values, thresholds)):
+        trace = _dial_trace(f"{cell_title}<br><span style='font-size:0.7em;color:red'>Target: {threshold}</span>",
+                            value, threshold)
+        trace['domain'] = {'row': idx // columns, 'column': idx % columns}
+        traces.append(trace)
+    columns = max(1, min(columns, len(traces)))
+    rows = max(1, math.ceil(len(traces) / columns))
+    layout = {
+        'template': _template_json('plotly_white'),
+        'grid': {'rows': rows, 'columns': columns, 'pattern': 'independent'},
+        'height': 250 * rows,
+    }
+    if title is not None:
+        layout['title'] = {'text': title}
+    return {'data': traces, 'layout': layout}
+
+
+def row_hashes(data: pd.DataFrame, *parts: Any) -> List[str]:
+    """content_hash cho từng dòng của data (biểu đồ theo dòng), băm cả partition một lần"""
+    prefix = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return [hashlib.md5(f"{prefix}:{value}".encode()).hexdigest()
+            for value in pd.util.hash_pandas_object(_hash_frame(data), index=False).tolist()]
+
+
+def chart_value_path(chart_type: str, config: Dict[str, Any], column: str, position: int) -> Optional[List[str]]:
+    """Đường dẫn JSON (cho jsonb_set) tới giá trị của cột column tại vị trí position trong figure đã lưu.
+
+    Dùng config do gen_dash ghi cho biểu đồ gộp nhiều dòng: value_columns theo thứ tự trace.
+    """
+    value_columns = config.get('value_columns') or []
+    if column not in value_columns:
+        return None
+    if chart_type == 'pie':
+        key = 'values'
+    elif chart_type == 'bar':
+        key = 'x' if config.get('orientation') == 'h' else 'y'
+    elif chart_type == 'line' and len(value_columns) == 1:
+        key = 'y'
+    else:
+        return None
+    # Nhiều cột giá trị: mỗi cột một trace (color_column='Metric') theo đúng thứ tự value_columns
+    trace = value_columns.index(column) if len(value_columns) > 1 else 0
+    return ['data', str(trace), key, str(position)]
+
+
+def template_key(template: Dict[str, Any]) -> str:
+    return hashlib.md5(json.dumps(template, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def split_template(figure: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str], Optional[Dict[str, Any]]]:
+    """Tách layout.template ra khỏi figure, trả về (figure, template_id, template)"""
+    template = (figure.get('layout') or {}).pop('template', None)
+    if template is None:
+        return figure, None, None
+    return figure, template_key(template), template
+
+
+def load_templates(conn, template_ids: Iterable[Optional[str]]) -> Dict[str, Dict[str, Any]]:
+    """Đọc các template dùng chung theo id (catalog.chart_templates), mỗi template chỉ đọc một lần"""
+    template_ids = sorted({tid for tid in template_ids if tid})
+    if not template_ids:
+        return {}
+    result = conn.execute(
+        text("SELECT id, template FROM catalog.chart_templates WHERE id = ANY(:ids)"), {'ids': template_ids}
+    )
+    return {row.id: row.template for row in result}
+
+
+def rehydrate_figure(figure: Dict[str, Any], template: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Gắn lại template dùng chung vào figure đã lưu dạng gọn"""
+    if template is not None and isinstance(figure, dict):
+        figure.setdefault('layout', {})['template'] = template
+    return figure
 
 
 class ChartService:
-    def __init__(self, engine):
+    def __init__(self, engine, backend: Optional[str] = None):
         self.engine = engine
-        self.meta = MetaData()
-        self.meta.reflect(bind=self.engine, schema="catalog")
-        self.charts = self.meta.tables['catalog.charts']
+        # 'plotly': dựng go.Figure qua plotly.express; 'native': ghép trực tiếp dict JSON của figure
+        self.backend = backend or settings.CHART_BACKEND
+        self.templates = None
+        self.compact = False
+        self.hashed = False
+        # engine = None: chỉ dùng để vẽ biểu đồ (ví dụ trong process con), không truy cập database
+        if engine is not None:
+            self.charts = get_table(self.engine, 'charts')
+            # Có bảng chart_templates thì lưu dạng gọn: template tách riêng, mỗi biểu đồ chỉ giữ template_id
+            self.templates = get_table(self.engine, 'chart_templates')
+            self.compact = self.templates is not None and 'template_id' in self.charts.c
+            # Có cột content_hash thì gen_dash chỉ vẽ lại các biểu đồ có dữ liệu thay đổi
+            self.hashed = 'content_hash' in self.charts.c
 
     def create_chart(self, data: pd.DataFrame, chart_type: str, title: str,
                      config: Optional[Dict[str, Any]] = None,
@@ -27,19 +231,27 @@ class ChartService:
         #     for column, value in filters.items():
         #         data = data[data[column] == value]
 
-        chart_creators = {
-            'bar': self.create_bar_chart,
-            'line': self.create_line_chart,
-            'pie': self.create_pie_chart,
-            'dial': self.create_dial_chart,
-        }
+        if self.backend == 'native':
+            chart_creators = {
+                'bar': self.build_bar_spec,
+                'line': self.build_line_spec,
+                'pie': self.build_pie_spec,
+                'dial': self.build_dial_spec,
+            }
+        else:
+            chart_creators = {
+                'bar': self.create_bar_chart,
+                'line': self.create_line_chart,
+                'pie': self.create_pie_chart,
+                'dial': self.create_dial_chart,
+            }
 
         if chart_type not in chart_creators:
             raise ValueError(f'Unsupported chart type: {chart_type}')
 
         fig = chart_creators[chart_type](data, title, config)
 
-        chart_json = fig.to_json()
+        chart_json = json.dumps(fig) if isinstance(fig, dict) else fig.to_json()
 
         return {
             'figure': fig,
@@ -158,53 +370,376 @@ class ChartService:
 
         return fig
 
+    def build_bar_spec(self, data: pd.DataFrame, title: str, config: Dict[str, Any]) -> Dict[str, Any]:
+        """Figure JSON tương đương create_bar_chart, không qua plotly.express"""
+        x_col = config.get('x_column', data.columns[0])
+        y_col = config.get('y_column', data.columns[1] if len(data.columns) > 1 else data.columns[0])
+        color_col = config.get('color_column')
+        orientation = config.get('orientation', 'v')
+        if orientation not in ['v', 'h']:
+            orientation = 'v'
+        x_axis, y_axis = (y_col, x_col) if orientation == 'h' else (x_col, y_col)
+
+        template = _template_json('plotly_white')
+        colorway = template['layout']['colorway']
+        legend = {'tracegroupgap': 0}
+        traces = []
+        if color_col and color_col in data.columns:
+            legend['title'] = {'text': color_col}
+            for i, (group, part) in enumerate(data.groupby(color_col, sort=False)):
+                group = _scalar(group)
+                traces.append(self._bar_trace(
+                    part, x_axis, y_axis, orientation, colorway[i % len(colorway)],
+                    name=str(group), showlegend=True,
+                    hover_prefix=f"{color_col}={group}<br>",
+                ))
+        else:
+            traces.append(self._bar_trace(data, x_axis, y_axis, orientation, colorway[0], name='', showlegend=False))
+
+        return {
+            'data': traces,
+            'layout': {
+                'template': template,
+                'xaxis': {'anchor': 'y', 'domain': [0.0, 1.0], 'title': {'text': config.get('x_title', x_col)}},
+                'yaxis': {'anchor': 'x', 'domain': [0.0, 1.0],
+                          'title': {'text': config.get('y_title', y_col) + ' (' + config.get('unit', '') + ')'}},
+                'legend': legend,
+                'title': {'text': title},
+                'barmode': config.get('barmode', 'group'),
+            },
+        }
+
+    @staticmethod
+    def _bar_trace(data: pd.DataFrame, x_axis: str, y_axis: str, orientation: str, color: str,
+                   name: str, showlegend: bool, hover_prefix: str = '') -> Dict[str, Any]:
+        return {
+            'alignmentgroup': 'True',
+            'hovertemplate': f"{hover_prefix}{x_axis}=%{{x}}<br>{y_axis}=%{{y}}<extra></extra>",
+            'legendgroup': name,
+            'marker': {'color': color, 'pattern': {'shape': ''}},
+            'name': name,
+            'offsetgroup': name,
+            'orientation': orientation,
+            'showlegend': showlegend,
+            'textposition': 'auto',
+            'x': _column_values(data[x_axis]),
+            'xaxis': 'x',
+            'y': _column_values(data[y_axis]),
+            'yaxis': 'y',
+            'type': 'bar',
+        }
+
+    def build_line_spec(self, data: pd.DataFrame, title: str, config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Figure JSON tương đương create_line_chart, không qua plotly.express"""
+        x_col = config.get('x_column', data.columns[0])
+        y_col = config.get('y_column', data.columns[1] if len(data.columns) > 1 else data.columns[0])
+        template = _template_json('plotly_white')
+
+        return {
+            'data': [{
+                'hovertemplate': f"{x_col}=%{{x}}<br>{y_col}=%{{y}}<extra></extra>",
+                'legendgroup': '',
+                'line': {'color': template['layout']['colorway'][0], 'dash': 'solid'},
+                'marker': {'symbol': 'circle'},
+                'mode': 'lines',
+                'name': '',
+                'orientation': 'v',
+                'showlegend': False,
+                'x': _column_values(data[x_col]),
+                'xaxis': 'x',
+                'y': _column_values(data[y_col]),
+                'yaxis': 'y',
+                'type': 'scatter',
+            }],
+            'layout': {
+                'template': template,
+                'xaxis': {'anchor': 'y', 'domain': [0.0, 1.0], 'title': {'text': config.get('x_title', x_col)}},
+                'yaxis': {'anchor': 'x', 'domain': [0.0, 1.0], 'title': {'text': config.get('y_title', y_col)}},
+                'legend': {'tracegroupgap': 0},
+                'title': {'text': title},
+            },
+        }
+
+    def build_pie_spec(self, data: pd.DataFrame, title: str, config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Figure JSON tương đương create_pie_chart, không qua plotly.express"""
+        names_col = config.get('names_column', data.columns[0])
+        values_col = config.get('values_column', data.columns[1] if len(data.columns) > 1 else data.columns[0])
+
+        return {
+            'data': [{
+                'domain': {'x': [0.0, 1.0], 'y': [0.0, 1.0]},
+                'hovertemplate': f"{names_col}=%{{label}}<br>{values_col}=%{{value}}<extra></extra>",
+                'labels': _column_values(data[names_col]),
+                'legendgroup': '',
+                'name': '',
+                'showlegend': True,
+                'values': _column_values(data[values_col]),
+                'type': 'pie',
+            }],
+            'layout': {
+                'template': _template_json('plotly_white'),
+                'legend': {'tracegroupgap': 0},
+                'title': {'text': title},
+            },
+        }
+
+    def build_dial_spec(self, data: pd.DataFrame, title: str, config: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Figure JSON tương đương create_dial_chart, không dựng go.Figure"""
+        value = config.get('value_column', data.columns[0])
+        threshold = config.get('threshold_column', data.columns[1] if len(data.columns) > 1 else data.columns[0])
+        return _dial_figure(title, value, threshold)
+
     def save_chart(self, dashboard_id:int, row_id:str, name: str, title: str, chart_type: str, json_data: str,
                      config: Dict[str, Any], filters: Optional[Dict[str, Any]] = None):
-
-        stmt = insert(self.charts).values(
-            dashboard_id=dashboard_id,
-            row_id=row_id,
-            name=name,
-            title=title,
-            type=chart_type,
-            json_data=json.loads(json_data),
-            config=config,
-            filters=filters or {},
-            created_at=datetime.now()
-        ).on_conflict_do_update(
-            index_elements=['dashboard_id', 'row_id'],  # cột bị xung đột
-            set_={
+        try:
+            self.save_charts([{
                 'dashboard_id': dashboard_id,
                 'row_id': row_id,
                 'name': name,
                 'title': title,
-                'type': chart_type,
-                'json_data': json.loads(json_data),
+                'chart_type': chart_type,
+                'json_data': json_data,
                 'config': config,
-                'filters': filters or {},
-                'created_at': datetime.now()
+                'filters': filters,
+            }])
+        except Exception as e:
+            print(f"Error saving chart: {e}")
+            raise e
+
+    def save_charts(self, charts: Iterable[Dict[str, Any]], batch_size: Optional[int] = None, conn=None) -> int:
+        """Upsert nhiều biểu đồ trong một transaction, mỗi câu lệnh ghi tối đa batch_size dòng"""
+        batch_size = batch_size or settings.CHART_SAVE_BATCH_SIZE
+        if conn is None:
+            with self.engine.begin() as conn:
+                return self.save_charts(charts, batch_size, conn)
+
+        created_at = datetime.now()
+        saved = 0
+        batch = {}
+        templates = {}
+        for chart in charts:
+            json_data = chart['json_data']
+            row = {
+                'dashboard_id': chart['dashboard_id'],
+                'row_id': chart['row_id'],
+                'name': chart['name'],
+                'title': chart['title'],
+                'type': chart['chart_type'],
+                'json_data': json.loads(json_data) if isinstance(json_data, str) else json_data,
+                'config': chart['config'],
+                'filters': chart.get('filters') or {},
+                'created_at': created_at,
             }
+            if self.hashed:
+                row['content_hash'] = chart.get('content_hash')
+            if self.compact:
+                row['json_data'], row['template_id'], template = split_template(row['json_data'])
+                if row['template_id'] is not None:
+                    templates[row['template_id']] = template
+            # Trùng (dashboard_id, row_id) trong cùng câu lệnh thì giữ bản ghi sau cùng
+            batch[(row['dashboard_id'], row['row_id'])] = row
+            if len(batch) >= batch_size:
+                self._save_templates(conn, templates)
+                saved += self._upsert_charts(conn, list(batch.values()))
+                batch, templates = {}, {}
+        if batch:
+            self._save_templates(conn, templates)
+            saved += self._upsert_charts(conn, list(batch.values()))
+        return saved
+
+    def _upsert_charts(self, conn, rows: List[Dict[str, Any]]) -> int:
+        columns = ['name', 'title', 'type', 'json_data', 'config', 'filters', 'created_at']
+        if self.compact:
+            columns.append('template_id')
+        if self.hashed:
+            columns.append('content_hash')
+        stmt = insert(self.charts).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['dashboard_id', 'row_id'],  # cột bị xung đột
+            set_={col: stmt.excluded[col] for col in columns}
         )
+        conn.execute(stmt)
+        return len(rows)
 
-        try:
+    def _save_templates(self, conn, templates: Dict[str, Dict[str, Any]]):
+        # Không cache id đã ghi: transaction (hoặc savepoint) của caller có thể bị rollback,
+        # nên mỗi batch luôn ghi lại template của nó trong cùng transaction
+        if not templates:
+            return
+        created_at = datetime.now()
+        conn.execute(insert(self.templates).values([
+            {'id': template_id, 'template': template, 'created_at': created_at}
+            for template_id, template in sorted(templates.items())
+        ]).on_conflict_do_nothing(index_elements=['id']))
+
+    def migrate_templates(self, batch_size: int = 500) -> int:
+        """Chuyển các biểu đồ cũ (template nằm trong json_data) sang dạng gọn"""
+        if not self.compact:
+            raise RuntimeError("catalog.chart_templates / charts.template_id chưa được tạo")
+        migrated = 0
+        with self.engine.begin() as conn:
+            while True:
+                rows = conn.execute(
+                    select(self.charts.c.id, self.charts.c.json_data)
+                    .where(self.charts.c.template_id.is_(None))
+                    .where(text("json_data->'layout' ? 'template'"))
+                    .limit(batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                templates, updates = {}, []
+                for chart_id, json_data in rows:
+                    figure, template_id, template = split_template(json_data)
+                    if template_id is not None:
+                        templates[template_id] = template
+                    updates.append((chart_id, figure, template_id))
+                self._save_templates(conn, templates)
+                for chart_id, figure, template_id in updates:
+                    conn.execute(
+                        self.charts.update().where(self.charts.c.id == chart_id)
+                        .values(json_data=figure, template_id=template_id)
+                    )
+                migrated += len(rows)
+        return migrated
+
+    def get_content_hashes(self, dashboard_id: int, conn=None) -> Dict[str, Optional[str]]:
+        """row_id -> content_hash của các biểu đồ hiện có trong dashboard"""
+        if conn is None:
             with self.engine.connect() as conn:
-                conn.execute(stmt)
-                conn.commit()
-        except Exception as e:
-            print(f"Error saving chart: {e}")
-            raise e
+                return self.get_content_hashes(dashboard_id, conn)
+        result = conn.execute(
+            select(self.charts.c.row_id, self.charts.c.content_hash)
+            .where(self.charts.c.dashboard_id == dashboard_id)
+        )
+        return {row.row_id: row.content_hash for row in result}
+
+    def delete_charts(self, dashboard_id: int, row_ids: Iterable[str], conn) -> int:
+        row_ids = list(row_ids)
+        if not row_ids:
+            return 0
+        result = conn.execute(
+            self.charts.delete()
+            .where(self.charts.c.dashboard_id == dashboard_id)
+            .where(self.charts.c.row_id.in_(row_ids))
+        )
+        return result.rowcount
+
+    def delete_dashboard_charts(self, dashboard_id: int, conn) -> int:
+        """Xóa toàn bộ biểu đồ của một dashboard trong transaction của caller"""
+        result = conn.execute(self.charts.delete().where(self.charts.c.dashboard_id == dashboard_id))
+        return result.rowcount
+
+    def patch_charts(self, patches: List[Dict[str, Any]], conn=None) -> int:
+        """Sửa trực tiếp từng giá trị trong json_data bằng jsonb_set, không vẽ lại biểu đồ.
+
+        Mỗi patch gồm dashboard_id, row_id, path (chart_value_path) và value ghi đè giá trị hiện có.
+        """
+        if not patches:
+            return 0
+        if conn is None:
+            with self.engine.begin() as conn:
+                return self.patch_charts(patches, conn)
+        stmt = text("""
+            UPDATE catalog.charts
+            SET json_data = jsonb_set(
+                json_data, CAST(:path AS TEXT[]),
+                COALESCE(to_jsonb(CAST(:value AS NUMERIC)), 'null'::jsonb)
+            )
+            WHERE dashboard_id = :dashboard_id AND row_id = :row_id
+        """)
+        # Khóa các dòng theo cùng một thứ tự để các worker song song không deadlock
+        patches = sorted(patches, key=lambda patch: (patch['dashboard_id'], patch['row_id']))
+        conn.execute(stmt, patches)
+        return len(patches)
 
     def truncate_charts(self):
         with self.engine.connect() as conn:
             conn.execute(text(f"TRUNCATE TABLE {self.charts} RESTART IDENTITY"))
             conn.commit()
 
-    def get_data_row_id(self, row_id: str):
-        query = text("""
-                     SELECT *
-                     FROM catalog.charts
-                     WHERE row_id = :row_id
-                     """)
-        with self.engine.connect() as conn:
-            result = conn.execute(query, {"row_id": row_id}).mappings().fetchone()
-            return dict(result) if result else None
\ No newline at end of file
+    def list_chart_descriptors(self, conn=None) -> Iterator[Dict[str, Any]]:
+        """Thông tin tất cả biểu đồ (không kèm json_data), dùng để nạp chỉ mục row_id"""
+        if conn is None:
+            with self.engine.connect() as conn:
+                yield from self.list_chart_descriptors(conn)
+            return
+        c = self.charts.c
+        result = conn.execute(select(c.id, c.dashboard_id, c.row_id, c.name, c.title, c.type, c.config, c.filters))
+        for row in result.mappings():
+            yield dict(row)
+
+
+# Mỗi process giữ một ChartService (không database) cho mỗi backend
+_renderers: Dict[str, ChartService] = {}
+
+
+def render_chart(spec: ChartSpec, backend: Optional[str] = None) -> Dict[str, Any]:
+    """Vẽ một ChartSpec thành bản ghi dùng cho ChartService.save_charts"""
+    backend = backend or settings.CHART_BACKEND
+    if spec.figure is not None:
+        res = {'json_data': spec.figure, 'config': spec.config, 'filters': spec.filters}
+    else:
+        renderer = _renderers.get(backend)
+        if renderer is None:
+            renderer = _renderers[backend] = ChartService(None, backend=backend)
+        res = renderer.create_chart(spec.data, spec.chart_type, spec.title, spec.config, spec.filters)
+    return {
+        'dashboard_id': spec.dashboard_id,
+        'row_id': spec.row_id,
+        'name': spec.name,
+        'title': spec.title,
+        'chart_type': spec.chart_type,
+        'json_data': res['json_data'],
+        'config': res['config'],
+        'filters': res['filters'],
+        'content_hash': spec.content_hash,
+    }
+
+
+def render_charts(specs: Iterable[ChartSpec], workers: Optional[int] = None,
+                  chunksize: Optional[int] = None, backend: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Vẽ nhiều biểu đồ trên process pool, trả kết quả dần theo thứ tự của specs.
+
+    backend: backend vẽ (mặc định CHART_BACKEND), truyền ChartService.backend để khớp với spec_hash.
+    """
+    workers = workers if workers is not None else settings.CHART_RENDER_WORKERS
+    chunksize = chunksize or settings.CHART_RENDER_CHUNKSIZE
+    backend = backend or settings.CHART_BACKEND
+    if workers <= 1:
+        yield from (render_chart(spec, backend) for spec in specs)
+        return
+
+    # executor.map gửi toàn bộ specs vào pool ngay lập tức; chỉ giữ tối đa 2 * workers lô đang chờ
+    # để specs được đọc dần theo tốc độ lưu. pending giữ đúng thứ tự specs: Future của một lô
+    # hoặc list bản ghi đã có sẵn
+    pending = deque()
+    running = 0
+    batch = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for spec in specs:
+            if spec.figure is None:
+                batch.append(spec)
+                if len(batch) < chunksize:
+                    continue
+            if batch:
+                pending.append(executor.submit(_render_chunk, batch, backend))
+                running += 1
+                batch = []
+            if spec.figure is not None:
+                # Figure đã dựng sẵn (ví dụ đồng hồ dựng theo lô) không cần gửi qua process pool
+                pending.append([render_chart(spec, backend)])
+            while pending and (isinstance(pending[0], list) or running >= 2 * workers
+                               or len(pending) > 2 * workers * chunksize):
+                item = pending.popleft()
+                if not isinstance(item, list):
+                    running -= 1
+                    item = item.result()
+                yield from item
+        if batch:
+            pending.append(executor.submit(_render_chunk, batch, backend))
+        for item in pending:
+            yield from (item if isinstance(item, list) else item.result())
+
+
+def _render_chunk(specs: List[ChartSpec], backend: str) -> List[Dict[str, Any]]:
+    return [render_chart(spec, backend) for spec in specs]
@@ -1,17 +1,19 @@
 from datetime import datetime
 from typing import *
 
-from sqlalchemy import MetaData, select
+from sqlalchemy import select
 from sqlalchemy.dialects.postgresql import insert
 
+from src.service.chart import load_templates, rehydrate_figure
+from src.service.metadata import get_table
+
 
 class DashboardService:
     def __init__(self, engine):
         self.engine = engine
-        self.meta = MetaData()
-        self.meta.reflect(bind=self.engine, schema="catalog")
-        self.dashboards = self.meta.tables['catalog.dashboards']
-        self.charts = self.meta.tables['catalog.charts']
+        self.dashboards = get_table(self.engine, 'dashboards')
+        self.charts = get_table(self.engine, 'charts')
+        self.templates = get_table(self.engine, 'chart_templates')
 
     def create_dashboard(self, id, name: str, description: Optional[str] = None):
         stmt = insert(self.dashboards).values(
@@ -41,4 +43,11 @@ class DashboardService:
             result = conn.execute(
                 select(self.charts).where(self.charts.c.dashboard_id == dashboard_id)
             )
-            return [dict(row._mapping) for row in result.fetchall()]
+            charts = [dict(row._mapping) for row in result.fetchall()]
+
+            # Biểu đồ lưu dạng gọn: đọc mỗi template một lần rồi gắn lại vào json_data
+            if self.templates is not None:
+                templates = load_templates(conn, (chart.get('template_id') for chart in charts))
+                for chart in charts:
+                    rehydrate_figure(chart['json_data'], templates.get(chart.get('template_id')))
+            return charts
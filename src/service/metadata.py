@@ -0,0 +1,56 @@
+import logging
+import threading
+from typing import *
+
+from sqlalchemy import MetaData, Table
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataRegistry:
+    """Giữ MetaData đã reflect cho mỗi (engine, schema), dùng chung trong cả process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metadata: Dict[Tuple[str, str], MetaData] = {}
+
+    @staticmethod
+    def _key(engine, schema: str) -> Tuple[str, str]:
+        # Nhiều engine trỏ tới cùng một database dùng chung một bản reflect
+        return engine.url.render_as_string(hide_password=False), schema
+
+    def get_metadata(self, engine, schema: str = "catalog") -> MetaData:
+        key = self._key(engine, schema)
+        meta = self._metadata.get(key)
+        if meta is not None:
+            return meta
+        with self._lock:
+            meta = self._metadata.get(key)
+            if meta is None:
+                meta = MetaData()
+                meta.reflect(bind=engine, schema=schema)
+                self._metadata[key] = meta
+                logger.info("Reflected %s tables from schema %s", len(meta.tables), schema)
+            return meta
+
+    def get_table(self, engine, name: str, schema: str = "catalog") -> Optional[Table]:
+        return self.get_metadata(engine, schema).tables.get(f"{schema}.{name}")
+
+    def refresh(self, engine=None, schema: Optional[str] = None) -> None:
+        """Bỏ bản reflect đã lưu (sau khi đổi DDL), lần gọi tiếp theo sẽ reflect lại"""
+        url = self._key(engine, schema)[0] if engine is not None else None
+        with self._lock:
+            for key in list(self._metadata):
+                if (url is None or key[0] == url) and (schema is None or key[1] == schema):
+                    del self._metadata[key]
+
+
+registry = MetadataRegistry()
+
+
+def get_table(engine, name: str, schema: str = "catalog") -> Optional[Table]:
+    return registry.get_table(engine, name, schema)
+
+
+def refresh_metadata(engine=None, schema: Optional[str] = None) -> None:
+    registry.refresh(engine, schema)
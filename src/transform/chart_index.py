@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from src.service.chart import ChartService
+
+logger = logging.getLogger(__name__)
+
+# Cột mô tả biểu đồ giữ trong bộ nhớ, không gồm json_data
+DESCRIPTOR_COLUMNS = ('dashboard_id', 'row_id', 'name', 'title', 'type', 'config', 'filters')
+
+
+class ChartIndex:
+    """Chỉ mục row_id -> mô tả biểu đồ cho syncer, nạp một lần và cập nhật theo các lần ghi của syncer.
+
+    Kèm chỉ mục hash_id -> vị trí trong các biểu đồ gộp (config.members do gen_dash ghi).
+    """
+
+    def __init__(self, chart_service: ChartService, refresh_interval: float = 0):
+        self.chart_service = chart_service
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._charts: Dict[str, Dict[str, Any]] = {}
+        # hash_id dòng gốc -> [(row_id biểu đồ gộp, vị trí trong mảng giá trị)]
+        self._members: Dict[str, List[Tuple[str, int]]] = {}
+        self.loaded_at = None
+
+    def refresh(self) -> int:
+        """Nạp lại toàn bộ từ catalog.charts, ví dụ sau khi gen_dash sinh lại biểu đồ"""
+        charts = {row['row_id']: _descriptor(row) for row in self.chart_service.list_chart_descriptors()}
+        members: Dict[str, List[Tuple[str, int]]] = {}
+        for row_id, chart in charts.items():
+            for member, position in ((chart['config'] or {}).get('members') or {}).items():
+                members.setdefault(member, []).append((row_id, position))
+        with self._lock:
+            self._charts = charts
+            self._members = members
+            self.loaded_at = time.monotonic()
+        logger.info(f"Loaded {len(charts)} charts into the row_id index")
+        return len(charts)
+
+    def refresh_if_stale(self) -> None:
+        if self.loaded_at is None or (
+                self.refresh_interval > 0 and time.monotonic() - self.loaded_at >= self.refresh_interval):
+            self.refresh()
+
+    def get(self, row_id: str) -> Optional[Dict[str, Any]]:
+        return self._charts.get(row_id)
+
+    def lookup(self, row_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        charts = self._charts
+        return {row_id: charts[row_id] for row_id in row_ids if row_id in charts}
+
+    def members(self, hash_id: str) -> List[Tuple[str, int]]:
+        """Các biểu đồ gộp nhiều dòng có chứa dòng hash_id, kèm vị trí của dòng trong figure"""
+        return self._members.get(hash_id, [])
+
+    def update(self, records: Iterable[Dict[str, Any]]) -> None:
+        """Cập nhật theo các bản ghi syncer vừa ghi bằng ChartService.save_charts"""
+        with self._lock:
+            for record in records:
+                self._charts[record['row_id']] = _descriptor({**record, 'type': record['chart_type']})
+
+    def __len__(self) -> int:
+        return len(self._charts)
+
+
+def _descriptor(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {column: row.get(column) for column in DESCRIPTOR_COLUMNS}
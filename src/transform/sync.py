@@ -1,11 +1,15 @@
-import logging, json, os
+import logging, json, os, time
 from datetime import datetime
 
-import pandas as pd
-from kafka import KafkaConsumer
+from collections import deque
+
+from kafka import ConsumerRebalanceListener, KafkaConsumer, OffsetAndMetadata, TopicPartition
 from sqlalchemy import create_engine
+from sqlalchemy.exc import DataError, IntegrityError
 from config.settings import settings
-from src.service.chart import ChartService
+from src.service.chart import ChartService, build_dial_figures, chart_value_path
+from src.transform.chart_index import ChartIndex
+from src.transform.workers import KeyedWorkerPool
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,36 +17,120 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def batch_offsets(messages):
+    """Offset cần commit cho mỗi partition: sau message cuối cùng của batch"""
+    offsets = {}
+    for message in messages:
+        partition = TopicPartition(message.topic, message.partition)
+        offsets[partition] = max(offsets.get(partition, 0), message.offset + 1)
+    return {partition: OffsetAndMetadata(offset, '', -1) for partition, offset in offsets.items()}
+
+
+def value_patches(chart_data, data, position):
+    """Các patch jsonb_set cho một dòng thay đổi nằm ở vị trí position của biểu đồ gộp chart_data"""
+    config = chart_data.get('config') or {}
+    # Chỉ ghi đè giá trị của biểu đồ không gộp: ghi lại nhiều lần vẫn cho cùng kết quả nên syncer
+    # phát lại batch (rewind, commit offset lỗi) không sao. Biểu đồ có aggregation (kể cả sum) cần
+    # cả nhóm để tính lại, chờ lần chạy gen_dash sau
+    if config.get('aggregation') is not None:
+        return
+    for column in config.get('value_columns') or []:
+        if column not in data:
+            continue
+        path = chart_value_path(chart_data['type'], config, column, position)
+        if path is None:
+            continue
+        yield {
+            'dashboard_id': chart_data['dashboard_id'],
+            'row_id': chart_data['row_id'],
+            'path': path,
+            'value': data[column],
+        }
+
+
+# Lỗi do chính dữ liệu của event: ghi lại bao nhiêu lần cũng vậy
+PERMANENT_ERRORS = (KeyError, ValueError, TypeError, DataError, IntegrityError)
+
+
+def is_permanent(error):
+    return isinstance(error, PERMANENT_ERRORS)
+
+
+class FlushOnRebalance(ConsumerRebalanceListener):
+    """Ghi và commit batch đang dở trước khi mất partition, tránh consumer mới xử lý trùng"""
+
+    def __init__(self, syncer):
+        self.syncer = syncer
+
+    def on_partitions_revoked(self, revoked):
+        logger.info(f"Partitions revoked: {revoked}")
+        self.syncer.flush()
+        self.syncer.commit_completed(wait=True)
+
+    def on_partitions_assigned(self, assigned):
+        # Consumer tự đọc tiếp từ offset đã commit của từng partition
+        logger.info(f"Partitions assigned: {assigned}")
+
+
 class Syncer:
     def __init__(self):
         self.kafka_config = {
             'bootstrap_servers': ['localhost:9092'],
             'auto_offset_reset': 'earliest',
-            'enable_auto_commit': True,
+            # Chỉ commit offset sau khi biểu đồ đã ghi xong vào target (xem flush)
+            'enable_auto_commit': False,
             'group_id': 'sync-pg-tables',
             'value_deserializer': lambda value: json.loads(value.decode('utf-8')),
         }
 
+        self.batch_size = settings.SYNC_BATCH_SIZE
+        self.batch_timeout_ms = settings.SYNC_BATCH_TIMEOUT_MS
+        self.retry_backoff = settings.SYNC_RETRY_BACKOFF_S
+        self.max_retries = settings.SYNC_MAX_RETRIES
+        # Số lần ghi lỗi liên tiếp, về 0 sau mỗi batch ghi xong
+        self.failures = 0
+        # Các message đã poll nhưng chưa ghi xong, offset của chúng chưa được commit
+        self.pending = []
+
+        # SYNC_WORKERS > 1: chia các dòng thay đổi cho nhiều worker theo hash_id
+        self.workers = settings.SYNC_WORKERS
+        self.queue_size = settings.SYNC_QUEUE_SIZE
+        self.pool = None
+        # Các batch đã giao cho worker, theo thứ tự poll: (messages, [(rows, future)])
+        self.in_flight = deque()
+
         self.consumer = None
         self.engine = None
+        self.chart = None
+        self.index = None
 
     def connect_kafka(self):
         try:
             self.consumer = KafkaConsumer(**self.kafka_config)
-            self.consumer.subscribe(pattern='^sourcepg\..*')
+            self.consumer.subscribe(pattern='^sourcepg\..*', listener=FlushOnRebalance(self))
         except Exception as e:
             logger.error(f'Failed to connect to Kafka: {e}')
 
     def connect_postgres(self):
         try:
-            self.engine = create_engine(settings.target_database_url)
+            # Một engine dùng chung cho mọi worker, pool đủ kết nối cho từng worker
+            self.engine = create_engine(settings.target_database_url, pool_size=max(5, self.workers),
+                                        max_overflow=self.workers, pool_pre_ping=True)
+            # Reflect catalog một lần lúc khởi động, các event sau dùng lại
+            self.chart = ChartService(self.engine)
+            self.index = ChartIndex(self.chart, settings.SYNC_INDEX_REFRESH_S)
+            self.index.refresh()
+            if self.workers > 1:
+                self.pool = KeyedWorkerPool(self.handle_updates, self.workers, self.queue_size)
         except Exception as e:
             logger.error(f'Failed to connect to Postgres Target: {e}')
 
     def consuming(self):
         try:
-            for message in self.consumer:
-                self.process_change_event(message)
+            while True:
+                self.poll_batch()
+                self.flush()
+                self.refresh_index()
         except KeyboardInterrupt:
             logger.info("Stop consumer")
         except Exception as e:
@@ -50,6 +138,178 @@ class Syncer:
         finally:
             self.cleanup()
 
+    def refresh_index(self):
+        """Nạp lại chỉ mục row_id theo chu kỳ SYNC_INDEX_REFRESH_S, chỉ khi không còn batch đang ghi"""
+        if self.in_flight:
+            return
+        try:
+            self.index.refresh_if_stale()
+        except Exception as e:
+            logger.warning(f"Failed to refresh chart index: {e}")
+
+    def poll_batch(self):
+        """Gom vào pending tối đa batch_size bản ghi, hoặc những gì nhận được trong batch_timeout_ms"""
+        deadline = time.monotonic() + self.batch_timeout_ms / 1000
+        while len(self.pending) < self.batch_size:
+            remaining_ms = int((deadline - time.monotonic()) * 1000)
+            if remaining_ms <= 0:
+                break
+            records = self.consumer.poll(timeout_ms=remaining_ms, max_records=self.batch_size - len(self.pending))
+            for partition_messages in records.values():
+                self.pending.extend(partition_messages)
+
+    def flush(self) -> bool:
+        """Ghi các message đang chờ rồi mới commit offset; ghi lỗi thì tua lại để poll nhận lại lần sau"""
+        if not self.pending:
+            return self.commit_completed()
+        messages, self.pending = self.pending, []
+
+        if self.pool is None:
+            try:
+                self.process_batch(messages)
+            except Exception as e:
+                if not self.failed(e):
+                    logger.error(f"Failed to apply batch of {len(messages)} events, will retry: {e}")
+                    self.rewind(messages)
+                    time.sleep(self.retry_backoff)
+                    return False
+                # Batch ghi trong một transaction nên đã rollback toàn bộ, ghi lại từng dòng
+                logger.error(f"Failed to apply batch of {len(messages)} events, applying one by one: {e}")
+                self.apply_each(self.coalesce(messages))
+            self.failures = 0
+            self.commit(batch_offsets(messages))
+            return True
+
+        # Chế độ nhiều worker: chia theo hash_id, commit khi batch này và các batch trước đều ghi xong.
+        # Hàng đợi của worker đầy thì submit bị chặn, consumer tạm ngừng poll.
+        rows = self.coalesce(messages)
+        jobs = self.pool.submit(rows, key=lambda data: data['hash_id'])
+        self.in_flight.append((messages, jobs))
+        return self.commit_completed()
+
+    def failed(self, error) -> bool:
+        """Đếm lần ghi lỗi; True nếu lỗi do dữ liệu (cần tách ra ghi từng dòng).
+
+        Lỗi tạm thời (mất kết nối, timeout...) được thử lại tối đa max_retries lần liên tiếp, quá số
+        đó thì dừng consumer: offset chưa commit nên lần chạy sau đọc lại từ batch lỗi.
+        """
+        self.failures += 1
+        if is_permanent(error):
+            return True
+        if self.failures > self.max_retries:
+            raise RuntimeError(f"Giving up after {self.failures} failed attempts") from error
+        return False
+
+    def apply_each(self, rows):
+        """Ghi từng dòng trong transaction riêng; dòng lỗi do dữ liệu được ghi log rồi bỏ qua"""
+        for data in rows:
+            attempts = 0
+            while True:
+                try:
+                    self.handle_updates([data])
+                    break
+                except Exception as e:
+                    if is_permanent(e):
+                        logger.error(f"Skipping change event of {data.get('hash_id')}: {e!r}, "
+                                     f"data: {json.dumps(data, default=str, ensure_ascii=False)}")
+                        break
+                    attempts += 1
+                    if attempts > self.max_retries:
+                        raise RuntimeError(f"Giving up on {data.get('hash_id')} after {attempts} attempts") from e
+                    logger.warning(f"Failed to apply change event of {data.get('hash_id')}, will retry: {e}")
+                    time.sleep(self.retry_backoff)
+
+    def commit_completed(self, wait: bool = False) -> bool:
+        """Commit offset của các batch đầu hàng đã ghi xong (wait=True: chờ tất cả)"""
+        offsets = {}
+        while self.in_flight:
+            messages, jobs = self.in_flight[0]
+            if not wait and not all(future.done() for _, future in jobs):
+                break
+            failed = [(rows, future.exception()) for rows, future in jobs if future.exception() is not None]
+            if failed:
+                self.commit(offsets)
+                error = failed[0][1]
+                if not self.failed(error):
+                    logger.error(f"Failed to apply batch of {len(messages)} events, will retry: {error}")
+                    self.retry_in_flight()
+                    return False
+                # Mỗi phần của worker là một transaction riêng: chỉ ghi lại từng dòng của các phần lỗi,
+                # sau khi các batch sau đã chạy xong, rồi tua lại các batch sau để giữ thứ tự theo hash_id
+                logger.error(f"Failed to apply batch of {len(messages)} events, applying one by one: {error}")
+                self.wait_in_flight()
+                self.in_flight.popleft()
+                self.apply_each([data for rows, _ in failed for data in rows])
+                self.failures = 0
+                self.commit(batch_offsets(messages))
+                if self.in_flight:
+                    self.retry_in_flight(backoff=False)
+                return False
+            self.in_flight.popleft()
+            self.failures = 0
+            offsets.update(batch_offsets(messages))
+        self.commit(offsets)
+        return True
+
+    def wait_in_flight(self):
+        for _, jobs in self.in_flight:
+            for _, future in jobs:
+                future.exception()
+
+    def retry_in_flight(self, backoff: bool = True):
+        # Chờ các batch sau batch lỗi chạy xong rồi tua lại về đầu batch lỗi: các batch sau
+        # cũng được ghi lại theo đúng thứ tự nên giá trị cuối cùng của mỗi hash_id vẫn đúng
+        self.wait_in_flight()
+        messages = [message for batch_messages, _ in self.in_flight for message in batch_messages]
+        self.in_flight.clear()
+        self.rewind(messages)
+        if backoff:
+            time.sleep(self.retry_backoff)
+
+    def commit(self, offsets):
+        if not offsets:
+            return
+        try:
+            self.consumer.commit(offsets)
+        except Exception as e:
+            # Ví dụ nhóm đang rebalance: consumer mới sẽ xử lý lại từ offset đã commit, ghi biểu đồ là upsert nên không sao
+            logger.warning(f"Failed to commit offsets: {e}")
+
+    def rewind(self, messages):
+        first_offsets = {}
+        for message in messages:
+            first_offsets.setdefault(TopicPartition(message.topic, message.partition), message.offset)
+        assigned = self.consumer.assignment()
+        for partition, offset in first_offsets.items():
+            if partition in assigned:
+                self.consumer.seek(partition, offset)
+
+    def process_batch(self, messages):
+        rows = self.coalesce(messages)
+        if rows:
+            self.handle_updates(rows)
+
+    @staticmethod
+    def coalesce(messages):
+        """Gộp các event theo hash_id, giữ after-image cuối cùng"""
+        latest = {}
+        for message in messages:
+            data = Syncer.change_after_image(message)
+            if data:
+                latest[data['hash_id']] = data
+        if latest:
+            logger.info(f'Processing {len(messages)} change events, {len(latest)} distinct rows')
+        return list(latest.values())
+
+    @staticmethod
+    def change_after_image(message):
+        if not message.value:
+            return None
+        payload = message.value.get('payload') or {}
+        if payload.get('op') in ('c', 'u'):
+            return payload.get('after')
+        return None
+
     def process_change_event(self, message):
         if not message.value:
             return
@@ -88,25 +348,57 @@ class Syncer:
     def handle_update(self, data):
         if not data:
             return
-        engine = self.engine
+        self.handle_updates([data])
 
-        row_id = data['hash_id']
+    def handle_updates(self, rows):
+        """Vẽ lại các dial và sửa trực tiếp giá trị trong các biểu đồ gộp, ghi trong một transaction"""
+        chart = self.chart
+        if self.index.loaded_at is None:
+            # Chỉ mục chưa nạp được (ví dụ lỗi lúc khởi động): nạp lại trước khi xử lý, lỗi thì cả batch
+            # được thử lại như lỗi tạm thời thay vì bị bỏ qua vì "không có biểu đồ"
+            self.index.refresh()
+        # Tra trong bộ nhớ: dòng không có biểu đồ bị bỏ qua mà không cần query
+        charts = self.index.lookup(data['hash_id'] for data in rows)
 
-        chart = ChartService(engine)
-        chart_data = chart.get_data_row_id(row_id)
-        chart_type = chart_data['type']
+        updates = []
+        patches = []
+        for data in rows:
+            chart_data = charts.get(data['hash_id'])
+            # Lưới đồng hồ (config grid) gộp nhiều dòng, không vẽ lại được từ một event
+            if chart_data is not None and chart_data['type'] == 'dial' \
+                    and not (chart_data.get('config') or {}).get('grid'):
+                updates.append((data, chart_data))
+            for row_id, position in self.index.members(data['hash_id']):
+                member_chart = self.index.get(row_id)
+                if member_chart is not None:
+                    patches.extend(value_patches(member_chart, data, position))
+        if not updates and not patches:
+            return
 
-        if chart_type == 'dial':
-            title = chart_data['title']
-            config = {
+        figures = build_dial_figures(
+            [chart_data['title'] for _, chart_data in updates],
+            [data['tt5'] for data, _ in updates],
+            [data['tt4'] for data, _ in updates],
+        )
+        records = [{
+            'dashboard_id': chart_data['dashboard_id'],
+            'row_id': data['hash_id'],
+            'name': data.get('ind_name') or chart_data['name'],
+            'title': chart_data['title'],
+            'chart_type': 'dial',
+            'json_data': figure,
+            'config': {
                 'value_column': data['tt5'],
                 'threshold_column': data['tt4'],
-            }
-            filters = chart_data.get('filters') or {}
-            single_row_data = pd.DataFrame([chart_data])
-            res = chart.create_chart(single_row_data, 'dial', title, config, filters)
-            chart.save_chart(chart_data['dashboard_id'], row_id, data["ind_name"], title,
-                                     'dial', res['json_data'], res['config'], res['filters'])
+            },
+            'filters': chart_data.get('filters') or {},
+        } for (data, chart_data), figure in zip(updates, figures)]
+
+        with self.engine.begin() as conn:
+            saved = chart.save_charts(records, conn=conn) if records else 0
+            patched = chart.patch_charts(patches, conn=conn)
+        self.index.update(records)
+        logger.info(f'Updated {saved} charts, patched {patched} values')
 
     # def handle_delete(self, table_name, data):
     #     if not data:
@@ -123,10 +415,13 @@ class Syncer:
     #     logger.info(f"Successfully delete from {target_table}: {data}")
     #
     def cleanup(self):
+        if self.pool:
+            self.pool.close()
+        if self.consumer:
+            # Message chưa ghi xong không được commit, lần chạy sau sẽ đọc lại từ offset đã commit
+            self.consumer.close(autocommit=False)
         if self.engine:
             self.engine.dispose()
-        if self.consumer:
-            self.consumer.close()
 
 
 
@@ -0,0 +1,60 @@
+import logging
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedWorkerPool:
+    """Nhóm thread xử lý theo key: cùng một key luôn vào cùng một thread nên giữ nguyên thứ tự.
+
+    Mỗi thread có hàng đợi giới hạn queue_size; hàng đợi đầy thì submit bị chặn (backpressure).
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], Any], workers: int, queue_size: int):
+        self.handler = handler
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"sync-worker-{idx}", daemon=True)
+            for idx, q in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def slot(self, key: Any) -> int:
+        # crc32 thay cho hash(): ổn định giữa các lần chạy
+        return zlib.crc32(str(key).encode()) % len(self.queues)
+
+    def submit(self, items: Iterable[Any], key: Callable[[Any], Any]) -> List[Tuple[List[Any], Future]]:
+        """Chia items theo key cho các thread, trả về (các item, Future) cho mỗi phần"""
+        groups: Dict[int, List[Any]] = {}
+        for item in items:
+            groups.setdefault(self.slot(key(item)), []).append(item)
+        jobs = []
+        for idx, group in groups.items():
+            future = Future()
+            self.queues[idx].put((group, future))
+            jobs.append((group, future))
+        return jobs
+
+    def _run(self, jobs: queue.Queue):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            items, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.handler(items))
+            except Exception as e:
+                future.set_exception(e)
+
+    def close(self):
+        for jobs in self.queues:
+            jobs.put(None)
+        for thread in self.threads:
+            thread.join()
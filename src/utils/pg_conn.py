@@ -1,3 +1,4 @@
+import io
 import os
 
 import psycopg2
@@ -16,6 +17,12 @@ TARG_PORT = os.getenv('POSTGRES_TARGET_PORT')
 TARG_USER = os.getenv('POSTGRES_TARGET_USER')
 TARG_PASSWORD = os.getenv('POSTGRES_TARGET_PASSWORD')
 
+def _csv_value(value):
+    # NULL là ô rỗng không có ngoặc kép, mọi giá trị khác đều được quote
+    if value is None:
+        return ''
+    return '"' + str(value).replace('"', '""') + '"'
+
 class PostgresConn:
     def __init__(self, dbtype, **kwargs):
         self.datasource = "PostgreSQL"
@@ -67,8 +74,13 @@ class PostgresConn:
         try:
             cursor.execute(query, params)
             return cursor.fetchall()
-        except OperationalError as e:
-            print(f"[ERROR] OperationalError: {e}")
+        except Exception as e:
+            if isinstance(e, OperationalError):
+                print(f"[ERROR] OperationalError: {e}")
+            # Keep a reused connection usable after a failed read,
+            # including statements cancelled by statement_timeout
+            if not self.conn.closed:
+                self.conn.rollback()
             raise
         finally:
             cursor.close()
@@ -114,4 +126,52 @@ class PostgresConn:
         except Exception as e:
             self.conn.rollback()
             print(f"[ERROR] Execute failed: {e}")
-            raise
\ No newline at end of file
+            raise
+
+    def copy_upsert(self, table, columns, key_columns, data, compare_columns=None):
+        """COPY dữ liệu vào bảng tạm rồi upsert một lần, chỉ cập nhật các dòng thực sự thay đổi"""
+        schema, _, name = table.rpartition('.')
+        target = sql.Identifier(schema, name) if schema else sql.Identifier(name)
+        stage = sql.Identifier(f"_stage_{name}")
+        update_columns = [col for col in columns if col not in key_columns]
+        compare_columns = compare_columns or update_columns
+
+        cols = sql.SQL(', ').join(map(sql.Identifier, columns))
+        keys = sql.SQL(', ').join(map(sql.Identifier, key_columns))
+        merge_sql = sql.SQL("""
+            INSERT INTO {target} ({cols})
+            SELECT DISTINCT ON ({keys}) {cols} FROM {stage}
+            ON CONFLICT ({keys}) DO UPDATE SET {updates}
+            WHERE ({current}) IS DISTINCT FROM ({incoming})
+        """).format(
+            target=target, cols=cols, keys=keys, stage=stage,
+            updates=sql.SQL(', ').join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(col)) for col in update_columns
+            ),
+            current=sql.SQL(', ').join(sql.Identifier(name, col) for col in compare_columns),
+            incoming=sql.SQL(', ').join(sql.SQL("EXCLUDED.{}").format(sql.Identifier(col)) for col in compare_columns),
+        )
+
+        buffer = io.StringIO()
+        for row in data:
+            buffer.write(','.join(_csv_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute(sql.SQL(
+                    "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP"
+                ).format(stage, target))
+                cursor.copy_expert(
+                    sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(stage, cols).as_string(self.conn),
+                    buffer
+                )
+                cursor.execute(merge_sql)
+                changed = cursor.rowcount
+            self.conn.commit()
+            return changed
+        except Exception as e:
+            self.conn.rollback()
+            print(f"[ERROR] Copy upsert failed: {e}")
+            raise
@@ -0,0 +1,40 @@
+import json
+
+import pandas as pd
+import pytest
+
+from src.service.chart import ChartService
+
+FRAME = pd.DataFrame({
+    'org_name': ['Phòng A', 'Phòng B', 'Phòng C'],
+    'tt4': [10.0, 20.5, None],
+    'tt5': [3, 7, 12],
+})
+
+# Dạng dài sau khi melt nhiều value_columns (gen_dash.build_rule_charts)
+LONG_FRAME = FRAME.melt(id_vars='org_name', value_vars=['tt5', 'tt4'], var_name='Metric', value_name='Value')
+
+CATEGORY_FRAME = FRAME.astype({'org_name': 'category'})
+
+CASES = {
+    'bar_v': (FRAME, 'bar', {'x_column': 'org_name', 'y_column': 'tt5', 'orientation': 'v', 'unit': 'người'}),
+    'bar_h': (FRAME, 'bar', {'x_column': 'org_name', 'y_column': 'tt5', 'orientation': 'h',
+                             'x_title': 'Phòng ban', 'y_title': 'Cư dân'}),
+    'bar_grouped': (LONG_FRAME, 'bar', {'x_column': 'org_name', 'y_column': 'Value', 'color_column': 'Metric',
+                                        'barmode': 'group'}),
+    'bar_categorical': (CATEGORY_FRAME, 'bar', {'x_column': 'org_name', 'y_column': 'tt5'}),
+    'line': (FRAME, 'line', {'x_column': 'org_name', 'y_column': 'tt5'}),
+    'pie': (FRAME, 'pie', {'names_column': 'org_name', 'values_column': 'tt5'}),
+    'dial': (FRAME, 'dial', {'value_column': 42, 'threshold_column': 80}),
+}
+
+
+def render(backend, data, chart_type, config):
+    res = ChartService(None, backend=backend).create_chart(data.copy(), chart_type, 'Tiêu đề', dict(config), {})
+    return json.loads(res['json_data'])
+
+
+@pytest.mark.parametrize('case', sorted(CASES))
+def test_native_matches_plotly(case):
+    data, chart_type, config = CASES[case]
+    assert render('native', data, chart_type, config) == render('plotly', data, chart_type, config)